@@ -0,0 +1,88 @@
+import os
+import signal
+import asyncio
+import threading
+
+
+async def run_shell(command, capture, timeout=None):
+    # asyncio version of the command runner of M4Processor.run_command ():
+    # returns the exit code, the output and the stderr, which is part of
+    # the output with CAPTURE (esyscmd).
+    pipe = asyncio.subprocess.PIPE
+    stderr = asyncio.subprocess.STDOUT if capture else asyncio.subprocess.PIPE
+    # in a session of its own so a timeout kills the whole command, not
+    # just the shell, as ShellPool does
+    process = await asyncio.create_subprocess_shell(command, stdout=pipe, stderr=stderr,
+                                                    start_new_session=True)
+    try:
+        (output, errors) = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        await process.wait()
+        raise Exception("Command '%s' timed out after %s seconds" % (command, timeout))
+    return (process.returncode, output.decode(), errors.decode() if errors else '')
+
+
+async def aiter_output(processor, source, name='-', chunk_size=8192,
+                       executor=None, max_pending=16):
+    # Async version of processor.iter_output (). Expansion runs in a
+    # worker thread of EXECUTOR, esyscmd and syscmd run as subprocesses
+    # of the event loop, so neither blocks other coroutines. At most
+    # MAX_PENDING chunks are queued before the worker waits.
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(max_pending)
+    stopped = threading.Event()
+    timeout = processor.config['syscmd_timeout']
+
+    def command_runner(command, capture):
+        future = asyncio.run_coroutine_threadsafe(run_shell(command, capture, timeout), loop)
+        return future.result()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        saved_command_runner = processor.command_runner
+        processor.command_runner = command_runner
+        chunks = processor.iter_output(source, name, chunk_size)
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    break
+                put((chunk, None))
+            put((None, None))
+        except Exception as e:
+            if not stopped.is_set():
+                put((None, e))
+        finally:
+            chunks.close()
+            processor.command_runner = saved_command_runner
+
+    worker = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            (chunk, error) = await queue.get()
+            if error is not None:
+                raise error
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        # unblock the worker if the consumer stopped early
+        stopped.set()
+        while not worker.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.wait([worker], timeout=0.05)
+        await worker
+
+
+async def aprocess_string(processor, text, name='-', executor=None):
+    # Async version of processor.process_string ().
+    chunks = []
+    async for chunk in aiter_output(processor, [text], name, executor=executor):
+        chunks.append(chunk)
+    return ''.join(chunks)
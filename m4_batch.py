@@ -0,0 +1,110 @@
+import io
+import os
+import sys
+import json
+import time
+import multiprocessing
+
+# state of a batch worker process
+worker_snapshot = None
+worker_dep_missing = False
+
+
+def load_manifest(path):
+    # A JSON list of jobs or one JSON job per line. A job is
+    # {"input": path, "output": path, "defines": {name: value},
+    #  "depfile": path}
+    # where all but "input" are optional. The depfile's rule is for the
+    # output, or the input without one.
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        jobs = json.loads(text)
+    else:
+        jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    for job in jobs:
+        if 'input' not in job:
+            raise Exception("batch job without input: %s" % json.dumps(job))
+    return jobs
+
+
+def init_worker(config, prelude, dep_missing=False):
+    # Load the prelude once, every job starts from its snapshot.
+    global worker_snapshot, worker_dep_missing
+    worker_dep_missing = dep_missing
+    from m4_processor import M4Processor
+    processor = M4Processor(config)
+    if prelude:
+        processor.load_prelude(prelude)
+    worker_snapshot = processor.snapshot()
+
+
+def render_job(indexed_job):
+    (index, job) = indexed_job
+    start = time.time()
+    output = None
+    error = None
+    # errprint, warnings and traces of the job are reported with its
+    # output, not interleaved with other jobs on the worker's stderr
+    messages = io.StringIO()
+    try:
+        processor = worker_snapshot.fork(error=messages)
+        for name, value in job.get('defines', {}).items():
+            processor.define_user_macro(name, value)
+        processor.add_dependency(os.path.abspath(job['input']))
+        with open(job['input']) as f:
+            chunks = list(processor.iter_output(f, job['input']))
+        if processor.exit_code:
+            error = "m4exit(%d)" % processor.exit_code
+        if job.get('output'):
+            with open(job['output'], 'w') as f:
+                f.writelines(chunks)
+        else:
+            output = ''.join(chunks)
+        if job.get('depfile'):
+            processor.write_depfile(job['depfile'], job.get('output') or job['input'],
+                                    worker_dep_missing)
+    except Exception as e:
+        error = str(e)
+    return (index, output, messages.getvalue(), error, time.time() - start)
+
+
+def run_batch(jobs, config, prelude=None, processes=None, summary=sys.stderr,
+              dep_missing=False):
+    # Render JOBS on a process pool. Results are reported in job order,
+    # returns 0 if every job succeeded and 1 otherwise.
+    if processes is None:
+        processes = os.cpu_count() or 1
+    start = time.time()
+    exitcode = 0
+    timings = []
+    indexed_jobs = list(enumerate(jobs))
+    chunksize = max(1, len(indexed_jobs) // (processes * 4))
+    pool = multiprocessing.Pool(processes, init_worker, (config, prelude, dep_missing))
+    try:
+        for (index, output, messages, error, elapsed) in \
+                pool.imap(render_job, indexed_jobs, chunksize):
+            job = jobs[index]
+            sys.stderr.write(messages)
+            if error is not None:
+                exitcode = 1
+                sys.stderr.write("%s: %s\n" % (job['input'], error))
+            elif output is not None:
+                sys.stdout.write(output)
+            timings.append((job['input'], elapsed, error is None))
+    finally:
+        pool.close()
+        pool.join()
+    if summary is not None:
+        write_summary(summary, timings, time.time() - start, processes)
+    return exitcode
+
+
+def write_summary(summary, timings, wall_time, processes, slowest=10):
+    total = sum(elapsed for (name, elapsed, ok) in timings)
+    failed = sum(1 for (name, elapsed, ok) in timings if not ok)
+    summary.write("%d jobs, %d failed, %.2f s on %d processes, %.2f ms per job\n" % \
+        (len(timings), failed, wall_time, processes,
+         total * 1000.0 / len(timings) if timings else 0.0))
+    for (name, elapsed, ok) in sorted(timings, key=lambda timing: -timing[1])[:slowest]:
+        summary.write("%10.2f ms  %s  %s\n" % (elapsed * 1000.0, 'ok  ' if ok else 'FAIL', name))
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+
+from m4_processor import M4Processor
+
+
+# Synthetic workloads. Each writes its input files to a directory and
+# returns the name of the main file. SCALE multiplies the amount of work.
+
+def workload_m4sugar(directory, scale):
+    # m4sugar style helpers: quoting, argument list recursion, foreach,
+    # joining and appending to macros
+    lines = ["changequote([, ])dnl",
+             "define([m4_define], [define([$1], [$2])])dnl",
+             "m4_define([m4_if], [ifelse($@)])dnl",
+             "m4_define([m4_car], [[$1]])dnl",
+             "m4_define([m4_cdr], [m4_if([$#], [0], [], [$#], [1], [], [[shift($@)]])])dnl",
+             "m4_define([m4_foreach], [pushdef([$1])_m4_foreach([$1], [$2], [$3])popdef([$1])])dnl",
+             "m4_define([_m4_foreach], [m4_if([$2], [()], [],"
+             " [define([$1], m4_car$2)$3[]_m4_foreach([$1], (m4_cdr$2), [$3])])])dnl",
+             "m4_define([m4_append], [define([$1], ifdef([$1], [defn([$1])[$3]])[$2])])dnl",
+             "m4_define([m4_join], [m4_if([$#], [1], [], [$#], [2], [[$2]],"
+             " [[$2][$1]m4_join([$1], shift(shift($@)))])])dnl",
+             "m4_define([AS_UPPER], [translit([$1], [a-z], [A-Z])])dnl"]
+    for i in range(40 * scale):
+        lines.append("m4_foreach([x], (alpha, beta, gamma, delta), "
+                     "[m4_append([list%d], AS_UPPER(x), [, ])])dnl" % i)
+        lines.append("list%d: m4_join([-], a%d, b, c, d)" % (i, i))
+    return write_file(directory, 'm4sugar.m4', '\n'.join(lines) + '\n')
+
+
+def workload_shift(directory, scale):
+    args = ','.join('a%d' % i for i in range(60))
+    lines = ["define(`count', `ifelse(`$#', `1', `$1', `count(shift($@))')')dnl",
+             "define(`last', `ifelse(`$#', `1', `$1', `last(shift($@))')')dnl"]
+    for i in range(10 * scale):
+        lines.append("count(%s) last(%s)" % (args, args))
+    return write_file(directory, 'shift.m4', '\n'.join(lines) + '\n')
+
+
+def workload_quoted_define(directory, scale):
+    body = ''.join("line %d with some `nested' quoted text, commas (and parens)\n" % i
+                   for i in range(4000 * scale))
+    text = "define(`big', `%s')dnl\nbig\n" % body
+    return write_file(directory, 'quoted.m4', text)
+
+
+def workload_regex(directory, scale):
+    lines = []
+    for i in range(300 * scale):
+        lines.append("patsubst(`the quick brown fox %d jumps over the lazy dog', `o\\(.\\)', `0\\1')"
+                     " translit(`The Quick Brown Fox %d', `a-zA-Z', `A-Za-z')"
+                     " regexp(`version %d.%d', `\\([0-9]+\\)\\.\\([0-9]+\\)', `\\2.\\1')" % \
+                     (i, i, i, i + 1))
+    return write_file(directory, 'regex.m4', '\n'.join(lines) + '\n')
+
+
+def workload_diversion(directory, scale):
+    lines = ["divert(1)dnl"]
+    row = "diverted text that goes to diversion one until it is undiverted at the end\n"
+    lines.append(row * (7000 * scale))
+    lines.append("divert(0)dnl\nbefore\nundivert(1)dnl\nafter")
+    return write_file(directory, 'diversion.m4', '\n'.join(lines) + '\n')
+
+
+def workload_includes(directory, scale):
+    lines = []
+    for i in range(300 * scale):
+        name = 'inc%d.m4' % i
+        write_file(directory, name, "define(`macro%d', `value %d')dnl\nincluded %d\n" % (i, i, i))
+        lines.append("include(`%s')macro%d" % (os.path.join(directory, name), i))
+    return write_file(directory, 'includes.m4', '\n'.join(lines) + '\n')
+
+
+def workload_eval(directory, scale):
+    lines = ["define(`forloop', `pushdef(`$1', `$2')_forloop($@)popdef(`$1')')dnl",
+             "define(`_forloop', `$4`'ifelse($1, `$3', `',"
+             " `define(`$1', incr($1))$0($@)')')dnl"]
+    for i in range(scale):
+        lines.append("forloop(`i', `1', `250', `eval((i * i + %d) %% 97 + i / 3) ')" % i)
+    return write_file(directory, 'eval.m4', '\n'.join(lines) + '\n')
+
+
+WORKLOADS = {'m4sugar' : workload_m4sugar,
+             'shift' : workload_shift,
+             'quoted_define' : workload_quoted_define,
+             'regex' : workload_regex,
+             'diversion' : workload_diversion,
+             'includes' : workload_includes,
+             'eval' : workload_eval}
+
+
+def write_file(directory, name, text):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+class CountingSink(object):
+    # output stream keeping only the amount of text
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+    def flush(self):
+        pass
+
+
+def render(source, trace=False):
+    processor = M4Processor({'sync_output' : False}, CountingSink(), CountingSink())
+    tokens = [0]
+    if trace:
+        def count_token(token, line):
+            tokens[0] += 1
+        processor.subscribe('token', count_token)
+    start = time.perf_counter()
+    processor.process_file(source)
+    elapsed = time.perf_counter() - start
+    processor.close()
+    return (elapsed, processor.output_stream.size, tokens[0])
+
+
+def run_workload(name, scale=1, repeat=3):
+    # Runs in a process of its own so that the peak RSS is the workload's.
+    with tempfile.TemporaryDirectory(prefix='m4bench') as directory:
+        source = WORKLOADS[name](directory, scale)
+        input_size = sum(os.path.getsize(os.path.join(directory, entry))
+                         for entry in os.listdir(directory))
+        times = []
+        for i in range(repeat):
+            (elapsed, output_size, dummy) = render(source)
+            times.append(elapsed)
+        # counting tokens and tracing memory slows the run down, so it
+        # isn't timed; the peak is that of the memory traced by
+        # tracemalloc, not a count of allocations
+        tracemalloc.start()
+        (dummy, dummy, tokens) = render(source, True)
+        (traced, peak_traced) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    best = min(times)
+    return {'name' : name,
+            'scale' : scale,
+            'seconds' : best,
+            'seconds_all' : times,
+            'tokens' : tokens,
+            'tokens_per_sec' : tokens / best,
+            'input_bytes' : input_size,
+            'output_bytes' : output_size,
+            'mb_per_sec' : input_size / best / 1e6,
+            'peak_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_traced_bytes' : peak_traced}
+
+
+def run_benchmarks(names, scale=1, repeat=3):
+    results = []
+    for name in names:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                          '--run-one', name, '--scale', str(scale),
+                                          '--repeat', str(repeat)])
+        results.append(json.loads(output))
+    return {'commit' : git_commit(),
+            'python' : sys.version.split()[0],
+            'created' : time.time(),
+            'results' : results}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(report, stream, baseline=None):
+    before = {}
+    if baseline:
+        before = dict((result['name'], result) for result in baseline['results'])
+    stream.write("%-14s %9s %12s %9s %10s %15s %9s\n" % \
+        ('workload', 'seconds', 'tokens/s', 'MB/s', 'rss KB', 'peak traced KB', 'change'))
+    for result in report['results']:
+        change = ''
+        if result['name'] in before:
+            change = '%+.1f%%' % ((result['seconds'] / before[result['name']]['seconds'] - 1) * 100)
+        stream.write("%-14s %9.3f %12.0f %9.3f %10d %15d %9s\n" % \
+            (result['name'], result['seconds'], result['tokens_per_sec'], result['mb_per_sec'],
+             result['peak_rss_kb'], result['peak_traced_bytes'] // 1024, change))
+
+
+def regressions(report, baseline, threshold):
+    # names of workloads more than THRESHOLD (a fraction) slower
+    before = dict((result['name'], result) for result in baseline['results'])
+    return [result['name'] for result in report['results'] if result['name'] in before and
+            result['seconds'] > before[result['name']]['seconds'] * (1 + threshold)]
+
+
+if __name__ == "__main__":
+
+    optParser = argparse.ArgumentParser(description='Benchmarks of the M4 macro processor.')
+    optParser.add_argument('workloads', nargs='*', default=sorted(WORKLOADS),
+                           help='Workloads to run, all by default: %s' % ', '.join(sorted(WORKLOADS)))
+    optParser.add_argument('--scale', type=int, default=1, dest='scale',
+                           help='Multiply the size of the workloads')
+    optParser.add_argument('--repeat', type=int, default=3, dest='repeat',
+                           help='Timed runs per workload, the fastest is reported')
+    optParser.add_argument('-o', '--output', default=None, dest='output',
+                           help='Store the results as JSON in this file')
+    optParser.add_argument('--compare', default=None, dest='compare',
+                           help='JSON results of an earlier run to compare with')
+    optParser.add_argument('--threshold', type=float, default=10.0, dest='threshold',
+                           help='Percentage of slowdown reported as a regression')
+    optParser.add_argument('--run-one', default=None, dest='run_one', help=argparse.SUPPRESS)
+    options = optParser.parse_args()
+
+    if options.run_one:
+        json.dump(run_workload(options.run_one, options.scale, options.repeat), sys.stdout)
+        sys.exit(0)
+
+    for name in options.workloads:
+        if name not in WORKLOADS:
+            sys.exit("Unknown workload '%s'" % name)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    report = run_benchmarks(options.workloads, options.scale, options.repeat)
+    write_report(report, sys.stdout, baseline)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if baseline:
+        slower = regressions(report, baseline, options.threshold / 100.0)
+        if slower:
+            sys.exit('Slower than %s: %s' % (options.compare, ', '.join(slower)))
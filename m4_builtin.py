@@ -1,10 +1,8 @@
-import sys
 import os
 import re
-import subprocess
 from tempfile import NamedTemporaryFile
 
-from m4_common import Macro, Token
+from m4_common import Macro, M4Exit
 
 def bad_args(arguments, min = -1, max = -1, exception=True):
     argc = len(arguments)
@@ -22,48 +20,48 @@ def bad_args(arguments, min = -1, max = -1, exception=True):
     return True
 
 def m4___file__(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 1)
     current_file = processor.current_file()
     name = current_file.name if current_file else ''
     return processor.config['left_quote'] + name + processor.config['right_quote']
 
 def m4___line__(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 1)
     current_file = processor.current_file()
     line = current_file.line if current_file else 0
     return processor.config['left_quote'] + str(line) + processor.config['right_quote']
 
 def m4___program__(processor, arguments):
-    processor.debug_builtin_call(arguments)
     raise Exception("Not implemeneted yet")
 
 
 # change comment delimiters
 def m4_changecom(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 3)
     if len(arguments) > 1:
         processor.config['begin_comment'] = arguments[1]
     if len(arguments) > 2:
         processor.config['end_comment'] = arguments[2]
-    processor.debug_output("m4_changecom(%s, %s)" % \
-            (processor.config['begin_comment'], processor.config['end_comment']))
+    processor.debug_output("m4_changecom(%s, %s)", \
+            processor.config['begin_comment'], processor.config['end_comment'])
+
+# change the syntax of macro names
+def m4_changeword(processor, arguments):
+    bad_args(arguments, 2, 2)
+    processor.set_word_regexp(arguments[1])
+    processor.debug_output("m4_changeword(%s)", processor.config['word_regexp'])
 
 # change quote delimiters
 def m4_changequote(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 3)
     if len(arguments) > 1:
         processor.config['left_quote'] = arguments[1]
     if len(arguments) > 2:
         processor.config['right_quote'] = arguments[2]
-    processor.debug_output("m4_changequote(%s, %s)" % \
-            (processor.config['left_quote'], processor.config['right_quote']))
+    processor.debug_output("m4_changequote(%s, %s)", \
+            processor.config['left_quote'], processor.config['right_quote'])
 
 def m4_debugmode(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 2)
     if len(arguments) > 1:
         processor.set_debug_level(arguments[1])
@@ -71,7 +69,6 @@ def m4_debugmode(processor, arguments):
         processor.set_debug_level()
 
 def m4_debugfile(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 2)
     if len(arguments) > 1:
         processor.debug_set_output(arguments[1])
@@ -79,7 +76,6 @@ def m4_debugfile(processor, arguments):
         processor.debug_set_output()
 
 def m4_traceoff(processor, arguments):
-    processor.debug_builtin_call(arguments)
     num_args = len(arguments)
     if num_args == 1:
         processor.set_trace(None, False)
@@ -89,7 +85,6 @@ def m4_traceoff(processor, arguments):
 
 
 def m4_traceon(processor, arguments):
-    processor.debug_builtin_call(arguments)
     num_args = len(arguments)
     if num_args == 1:
         processor.set_trace(None, True)
@@ -99,14 +94,12 @@ def m4_traceon(processor, arguments):
 
 
 def m4_decr(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2, 2)
     num_value = int(arguments[1])
     num_value -= 1
     return str(num_value)
 
 def m4_incr(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2, 2)
     num_value = int(arguments[1])
     num_value += 1
@@ -130,27 +123,22 @@ def define_macro(processor, arguments, mode):
 
 
 def m4_define(processor, arguments):
-    processor.debug_builtin_call(arguments)
     define_macro(processor, arguments, 'insert')
 
 def m4_undefine(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     for i in range(1, len(arguments)):
         processor.lookup_macro(arguments[i], 'delete')
 
 def m4_pushdef(processor, arguments):
-    processor.debug_builtin_call(arguments)
     define_macro(processor, arguments, 'pushdef')
 
 def m4_popdef(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     for i in range(1, len(arguments)):
         processor.lookup_macro(arguments[i], 'popdef')
 
 def m4_defn(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     for i in range(1, len(arguments)):
         argument = arguments[1]
@@ -173,18 +161,15 @@ def m4_defn(processor, arguments):
     return None
 
 def m4_divert(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 2)
     divnum = arguments[1] if len(arguments) > 1 else '0'
     processor.make_diversion(divnum) # accept strings
 
 def m4_divnum(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 1)
     return str(processor.current_diversion)
 
 def m4_undivert(processor, arguments):
-    processor.debug_builtin_call(arguments)
     num_args = len(arguments)
     if num_args == 1:
         processor.undivert_all()
@@ -193,19 +178,15 @@ def m4_undivert(processor, arguments):
             processor.undivert(arguments[i])
 
 def m4_dnl(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 1)
     processor.skip_line()
 
 def m4_errprint(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     errmsg = arguments[1]
-    sys.stderr.write(errmsg)
-    sys.stderr.flush()
+    processor.write_error(errmsg)
 
 def m4_eval(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2, 4)
     eval_str = arguments[1]
     if len(arguments) > 2 and arguments[2]:
@@ -224,12 +205,11 @@ def m4_eval(processor, arguments):
     eval_str = eval_str.replace('&&', ' and ')
     eval_str = eval_str.replace('!', 'not ')
     # eval
-    processor.debug_output("EVAL: %s" % eval_str)
+    processor.debug_output("EVAL: %s", eval_str)
     result = eval(eval_str)
     return "%d" % result
 
 def m4_format(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     format_str = arguments[1]
     # convert values to format type
@@ -244,7 +224,6 @@ def m4_format(processor, arguments):
     return format_str % tuple(values)
 
 def m4_ifdef(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 3, 4)
     symbol = arguments[1]
     # symbol is defined
@@ -257,7 +236,6 @@ def m4_ifdef(processor, arguments):
     return result
 
 def m4_ifelse(processor, arguments):
-    processor.debug_builtin_call(arguments)
     num_arguments = len(arguments)
     if num_arguments == 2:
         return None
@@ -291,21 +269,22 @@ def include(processor, arguments, silent):
         if not silent:
             raise Exception("cannot open '%s'" % filename)
         return None
-    processor.push_file(filename, filepath)
+    # only includes at top level can be replayed from the cache
+    if processor.include_cache is not None and processor.expansion_level == 1:
+        processor.include_cache.include(filename, filepath)
+    else:
+        processor.push_file(filename, filepath)
 
 # Include a file, complaining in case of errors.
 def m4_include(processor, arguments):
-    processor.debug_builtin_call(arguments)
     include(processor, arguments, False)
 
 # Include a file, ignoring errors.
 def m4_sinclude(processor, arguments):
-    processor.debug_builtin_call(arguments)
     include(processor, arguments, True)
 
 def m4_indir(processor, arguments):
     # indirect execute macro
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     name = arguments[1]
     macro = processor.lookup_macro(name)
@@ -323,7 +302,6 @@ def m4_indir(processor, arguments):
 # possible to redefine builtins, and still access their origina
 # definition.  This macro is not available in compatibility mode.
 def m4_builtin(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     name = arguments[1]
     bp = find_builtin_by_name(name)
@@ -338,7 +316,6 @@ def m4_builtin(processor, arguments):
     func(processor, sub_arguments)
 
 def m4_index(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 3, 3)
     haystack = arguments[1]
     string = arguments[2]
@@ -346,13 +323,11 @@ def m4_index(processor, arguments):
     return str(result)
 
 def m4_len(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2, 2)
     length = len(arguments[1])
     return str(length)
 
 def m4_substr(processor, arguments):
-    processor.debug_builtin_call(arguments)
     num_args = len(arguments)
     if not bad_args(arguments, 3, 4, False):
         if num_args == 2:
@@ -372,15 +347,12 @@ def m4_substr(processor, arguments):
         return string[start:]
 
 def m4_m4exit(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 1, 2)
     exitcode = 0
-    if len(arguments) > 1:
-        exitcode = arguments[1]
-    processor.debug_output("m4_m4exit(%s)" % exitcode)
-    sys.stdout.flush()
-    sys.stderr.flush()
-    sys.exit(exitcode)
+    if len(arguments) > 1 and arguments[1]:
+        exitcode = int(arguments[1])
+    processor.debug_output("m4_m4exit(%s)", exitcode)
+    raise M4Exit(exitcode)
 
 def normalize_regexp(regexp):
     regexp = regexp.replace(r'\(', '(')
@@ -412,7 +384,6 @@ def substitute(processor, text, repl, match):
             offset = index
 
 def m4_patsubst(processor, arguments):
-    processor.debug_builtin_call(arguments)
     num_args = len(arguments)
     if not bad_args(arguments, 3, 4, False):
         # builtin(`patsubst') is blank, but patsubst(`abc') is abc.
@@ -432,7 +403,6 @@ def m4_patsubst(processor, arguments):
     return result
 
 def m4_regexp(processor, arguments):
-    processor.debug_builtin_call(arguments)
     num_args = len(arguments)
     if not bad_args(arguments, 3, 4, False):
         # builtin(`regexp') is blank, but regexp(`abc') is 0.
@@ -450,7 +420,6 @@ def m4_regexp(processor, arguments):
             return substitute(processor, text, repl, match)
 
 def m4_shift(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     return processor.dump_args(arguments[1:], True)
 
@@ -488,7 +457,6 @@ def expand_ranges(string):
 
 
 def m4_translit(processor, arguments):
-    processor.debug_builtin_call(arguments)
     if not bad_args(arguments, 3, 4, False):
         #  builtin(`translit') is blank, but translit(`abc') is abc.
         if len(arguments) <= 2:
@@ -521,7 +489,6 @@ def m4_translit(processor, arguments):
     return result
 
 def m4_dumpdef(processor, arguments):
-    processor.debug_builtin_call(arguments)
     num_args = len(arguments)
     if num_args == 1:
         processor.dump_all_macros()
@@ -530,43 +497,39 @@ def m4_dumpdef(processor, arguments):
             processor.dump_macro(arguments[i])
 
 def m4_m4wrap(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2)
     if processor.config['no_gnu_extensions']:
-        return arguments[1]
+        text = arguments[1]
     else:
-        return  processor.dump_args(arguments[1:], False, ' ')
+        text = processor.dump_args(arguments, False, ' ')
+    processor.wrap_queue.append(text)
 
 
 def m4_esyscmd(processor, arguments):
-    processor.debug_builtin_call(arguments)
     if not bad_args(arguments, 2, 2, False):
         #  The empty command is successful.
         processor.returncode = 0
         return
-    try:
+    for path in processor.config['esyscmd_inputs']:
+        processor.add_dependency(path, os.path.exists(path))
+    cache = processor.esyscmd_cache
+    result = cache.lookup(arguments[1]) if cache is not None else None
+    if result is None:
         # original version of the 'esyscmd', it doesn't return error in stdout
-        # processor.returncode = subprocess.check_output(arguments[1], shell=True)
-        output = subprocess.check_output(arguments[1], stderr=subprocess.STDOUT, shell=True)
-        processor.returncode = 0
-    except subprocess.CalledProcessError as e:
-        processor.returncode = e.returncode
-        output = e.output
+        result = processor.run_command(arguments[1], True)
+        if cache is not None:
+            cache.store(arguments[1], result[0], result[1])
+    (processor.returncode, output) = result
     return output
 
 def m4_syscmd(processor, arguments):
-    processor.debug_builtin_call(arguments)
     if not bad_args(arguments, 2, 2, False):
         #  The empty command is successful.
         processor.returncode = 0
         return
-    try:
-        processor.returncode = subprocess.check_call(arguments[1], shell=True)
-    except subprocess.CalledProcessError as e:
-        processor.returncode = e.returncode
+    (processor.returncode, output) = processor.run_command(arguments[1], False)
 
 def m4_sysval(processor, arguments):
-    processor.debug_builtin_call(arguments)
     return str(processor.returncode)
 
 def mkstemp_helper(processor, macro_name, pattern):
@@ -575,17 +538,14 @@ def mkstemp_helper(processor, macro_name, pattern):
         NamedTemporaryFile(prefix=pattern).name + processor.config['right_quote']
 
 def m4_maketemp(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2, 2)
     return mkstemp_helper(processor, arguments[0], arguments[1])
 
 def m4_mkstemp(processor, arguments):
-    processor.debug_builtin_call(arguments)
     bad_args(arguments, 2, 2)
     return mkstemp_helper(processor, arguments[0], arguments[1])
 
 def m4_placeholder(processor, arguments):
-    processor.debug_builtin_call(arguments)
     raise Exception("Not implemeneted yet")
 
 builtin_tab = [
@@ -596,6 +556,7 @@ builtin_tab = [
     ( "builtin",          True,   True,   True,   m4_builtin ), 
     ( "changecom",        False,  False,  False,  m4_changecom ), 
     ( "changequote",      False,  False,  False,  m4_changequote ), 
+    ( "changeword",       True,   False,  True,   m4_changeword ),
     ( "debugmode",        True,   False,  False,  m4_debugmode ),
     ( "debugfile",        True,   False,  False,  m4_debugfile ),
     ( "decr",             False,  False,  True,   m4_decr ),
@@ -637,6 +598,25 @@ builtin_tab = [
     ( "placeholder",      True,   False,  False,  m4_placeholder )
 ]
 
+# builtins whose expansion depends only on their arguments
+pure_builtin_tab = frozenset([
+    "decr", "eval", "format", "ifelse", "incr", "index", "len",
+    "patsubst", "regexp", "shift", "substr", "translit"
+])
+
+# builtins with effects beyond the macro table
+side_effect_builtin_tab = frozenset([
+    "debugfile", "debugmode", "dumpdef", "errprint", "esyscmd", "include",
+    "m4exit", "m4wrap", "maketemp", "mkstemp", "sinclude", "syscmd",
+    "traceoff", "traceon", "undivert"
+])
+
+# builtins whose expansion depends on where the input is read or on
+# earlier output and commands, or that call a builtin chosen at run time
+state_builtin_tab = frozenset([
+    "__file__", "__line__", "builtin", "divnum", "indir", "sysval"
+])
+
 predefined_tab = [
     ("unix",     "__unix__",   ""),
     ("windows", "__windows__", ""),
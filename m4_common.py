@@ -1,3 +1,5 @@
+import codecs
+
 
 class Macro(object):
     # The data for a token, a macro argument, and a macro definition.
@@ -29,6 +31,8 @@ class Token(object):
     TOKEN_SIMPLE = 6  # any other single character
     TOKEN_MACDEF = 7  # a macro's definition (see "defn")
 
+    name = None # macro name of a TOKEN_WORD, data is its text
+
     def __init__(self, type):
         self.type = type
         self.data = None
@@ -47,6 +51,130 @@ class Token(object):
             return "%s (%s)" % (types[self.type - self.TOKEN_EOF], self.data)
 
 
+class M4Exit(Exception):
+    # Raised by m4exit to stop processing, carries the exit code.
+    def __init__(self, code):
+        Exception.__init__(self, "m4exit(%d)" % code)
+        self.code = code
+
+
+class BudgetExceeded(Exception):
+    # Raised when a run exceeds one of its resource budgets. CALL_STACK
+    # lists (macro, file, line) of the expansions in progress.
+    def __init__(self, msg, call_stack):
+        lines = [msg]
+        if call_stack:
+            lines.append("m4 call stack, innermost last:")
+            if len(call_stack) > 20:
+                lines.append("  ... %d more" % (len(call_stack) - 20))
+            for (name, filename, line) in call_stack[-20:]:
+                lines.append("  %s at %s:%d" % (name, filename, line))
+        Exception.__init__(self, '\n'.join(lines))
+        self.call_stack = call_stack
+
+
+class SharedDict(object):
+    # Dictionary layered over a frozen base dictionary which is shared
+    # between processor snapshots. Changes are kept in the local layer, so
+    # a copy costs only what is changed afterwards. Values must not be
+    # modified in place.
+    def __init__(self, base=None):
+        self.base = base if base is not None else {}
+        self.local = {}
+        self.removed = set()
+
+    def freeze(self):
+        # Merge the layers into a new base and return it. The returned
+        # dictionary must never be changed, copies refer to it.
+        if self.local or self.removed:
+            base = dict(self.base)
+            for name in self.removed:
+                base.pop(name, None)
+            base.update(self.local)
+            self.base = base
+            self.local = {}
+            self.removed = set()
+        return self.base
+
+    def __contains__(self, name):
+        if name in self.local:
+            return True
+        return name in self.base and name not in self.removed
+
+    def __getitem__(self, name):
+        if name in self.local:
+            return self.local[name]
+        if name in self.removed:
+            raise KeyError(name)
+        return self.base[name]
+
+    def get(self, name, default=None):
+        if name in self.local:
+            return self.local[name]
+        if name in self.removed:
+            return default
+        return self.base.get(name, default)
+
+    def __setitem__(self, name, value):
+        self.local[name] = value
+        self.removed.discard(name)
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.local.pop(name, None)
+        if name in self.base:
+            self.removed.add(name)
+
+    def pop(self, name, *default):
+        if name in self:
+            value = self[name]
+            del self[name]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(name)
+
+    def keys(self):
+        for name in self.base:
+            if name not in self.local and name not in self.removed:
+                yield name
+        for name in self.local:
+            yield name
+
+    def __iter__(self):
+        return self.keys()
+
+    def items(self):
+        for name in self.keys():
+            yield (name, self[name])
+
+    def values(self):
+        for name in self.keys():
+            yield self[name]
+
+    def __len__(self):
+        return len(self.base) - len(self.removed) + \
+            sum(1 for name in self.local if name not in self.base or name in self.removed)
+
+
+class OutputBuffer(object):
+    # Collects output text until it is taken as one chunk.
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+
+    def take(self):
+        text = ''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return text
+
+
 class Block(object):
     INPUT_STRING = 0    # String resulting from macro expansion.
     INPUT_FILE = 1      # File from command line or include.
@@ -55,11 +183,15 @@ class Block(object):
     CHAR_EOF = "-1"   # character return on EOF
     CHAR_MACRO = "-2" # character return for MACRO token
 
+    complete = True # all of the content is there, see StreamBlock
+
     def __init__(self, type, arg1, arg2 = None):
         self.type = type
         self.line = 1
         self.offset = 0
         self.start_of_input_line = False
+        self.macro = None # name of the macro whose expansion this is
+        self.call_id = 0 # macro_call_id when that expansion was pushed
         if type == self.INPUT_FILE:
             self.name = arg1
             self.content = self.read_file(arg2)
@@ -71,9 +203,17 @@ class Block(object):
             self.content = arg1
         else:
             raise Exception("Unknown input block type %d" % type)
+        # innermost block with a name, see M4Processor.current_file ()
+        self.file = self if self.name is not None else None
 
-    def read_file(self, filepath):
-        return open(filepath).read()
+    def read_file(self, source):
+        # path, file object or iterable of text chunks
+        if isinstance(source, str):
+            with open(source) as f:
+                return f.read()
+        if hasattr(source, 'read'):
+            return source.read()
+        return ''.join(source)
 
     def next_symbol(self):
         # check new line start
@@ -103,3 +243,48 @@ class Block(object):
         else:
             return "%s line %d" % (types[self.type - self.INPUT_STRING], self.line)
 
+
+class StreamBlock(Block):
+    # Input file read as data arrives, from a pipe or a terminal. Content
+    # already scanned is dropped on every read and WAIT is called before
+    # each read, which may block.
+    def __init__(self, name, stream, wait=None, chunk_size=65536):
+        Block.__init__(self, Block.INPUT_FILE, name, [])
+        self.complete = False
+        self.stream = stream
+        self.wait = wait
+        self.chunk_size = chunk_size
+        self.buffer = getattr(stream, 'buffer', None)
+        self.decoder = None
+        if self.buffer is not None and hasattr(self.buffer, 'read1'):
+            # read1 () returns the bytes that have arrived without waiting
+            # for a whole chunk
+            self.decoder = codecs.getincrementaldecoder(stream.encoding or 'utf-8')( \
+                stream.errors or 'strict')
+
+    def read_chunk(self):
+        # returns (text, end of stream)
+        if self.decoder is not None:
+            data = self.buffer.read1(self.chunk_size)
+            return (self.decoder.decode(data, not data), not data)
+        text = self.stream.readline()
+        return (text, not text)
+
+    def fill(self, size):
+        while not self.complete and len(self.content) - self.offset < size:
+            if self.wait is not None:
+                self.wait()
+            (text, self.complete) = self.read_chunk()
+            self.content = self.content[self.offset:] + text
+            self.offset = 0
+
+    def next_symbol(self):
+        if self.offset >= len(self.content):
+            self.fill(1)
+        return Block.next_symbol(self)
+
+    def peek_symbol(self, shift = 0):
+        if self.offset + shift >= len(self.content):
+            self.fill(shift + 1)
+        return Block.peek_symbol(self, shift)
+
@@ -0,0 +1,227 @@
+import os
+import hashlib
+
+from m4_common import Macro, Token, Block
+from m4_builtin import find_builtin_by_addr, pure_builtin_tab
+
+
+class DynamicConstruct(Exception):
+    # A construct whose effect the compiler can't capture was reached.
+    pass
+
+
+class NullStream(object):
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+class CompiledTemplate(object):
+    # Python code writing the output of a template. render () replays the
+    # output up to the first dynamic construct and returns the input state
+    # to resume the interpreter at, the end of the template if there is
+    # none.
+    def __init__(self, key, source):
+        self.key = key
+        self.source = source
+        namespace = {}
+        exec(compile(source, '<m4 template %s>' % key[:12], 'exec'), namespace)
+        self.function = namespace['render']
+        self.resume = namespace['RESUME']
+
+
+class TemplateCompiler(object):
+    # Compiles templates against the frozen macros of SNAPSHOT. Top level
+    # spans of the template whose expansion only calls text macros and
+    # the builtins in STATIC_BUILTINS become constant output, the first
+    # other span and everything after it is left to the interpreter.
+    # Compiled templates are kept by content hash in memory and as Python
+    # modules in DIRECTORY.
+    VERSION = 1
+    STATIC_BUILTINS = pure_builtin_tab | frozenset([
+        '__file__', '__line__', '__program__', 'defn', 'divert', 'divnum', 'dnl', 'ifdef'])
+
+    def __init__(self, snapshot, directory=None):
+        self.snapshot = snapshot
+        self.directory = directory
+        self.compiled = {}
+        self.fingerprint = self.make_fingerprint()
+        self.hits = 0
+        self.misses = 0
+
+    def make_fingerprint(self):
+        snapshot = self.snapshot
+        digest = hashlib.sha256()
+        digest.update(('%d\0' % self.VERSION).encode('utf-8'))
+        for name in ('left_quote', 'right_quote', 'begin_comment', 'end_comment', \
+                     'word_regexp', 'sync_output', 'nesting_limit', 'no_gnu_extensions'):
+            digest.update(('%s\0' % snapshot.config[name]).encode('utf-8'))
+        for name in sorted(snapshot.macrostab.keys()):
+            digest.update(('%s\0' % name).encode('utf-8'))
+            for macro in snapshot.macrostab[name]:
+                if macro.type == Macro.TOKEN_DATA_FUNC:
+                    data = '\1%s' % find_builtin_by_addr(macro.data)[0]
+                else:
+                    data = '\2%s' % macro.data
+                digest.update(('%s\0%s\0' % (data, macro.traced)).encode('utf-8'))
+        for (divnum, text) in sorted(snapshot.diversions.items()):
+            digest.update(('%d\0%s\0' % (divnum, text)).encode('utf-8'))
+        digest.update(('%s\0%s\0%s\0%s\0%s\0' % \
+            (snapshot.current_diversion, snapshot.start_of_output_line,
+             snapshot.output_current_line, snapshot.debug_level,
+             snapshot.comments)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def make_key(self, text, name):
+        digest = hashlib.sha256()
+        digest.update(('%s\0%s\0' % (self.fingerprint, name)).encode('utf-8'))
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def module_path(self, key):
+        return os.path.join(self.directory, 'm4c_%s.py' % key)
+
+    def get(self, text, name):
+        key = self.make_key(text, name)
+        template = self.compiled.get(key)
+        if template is not None:
+            self.hits += 1
+            return template
+        source = None
+        if self.directory:
+            try:
+                with open(self.module_path(key)) as f:
+                    source = f.read()
+            except (IOError, OSError):
+                pass
+        if source is None:
+            self.misses += 1
+            source = self.compile(text, name)
+            if self.directory:
+                self.store(key, source)
+        else:
+            self.hits += 1
+        template = self.compiled[key] = CompiledTemplate(key, source)
+        return template
+
+    def store(self, key, source):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.module_path(key)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(source)
+        os.replace(temp_path, path)
+
+    def compile(self, text, name):
+        # Expand TEXT span by span in a throwaway processor recording the
+        # output and diversion changes, return the Python source.
+        processor = self.snapshot.fork(NullStream(), NullStream())
+        processor.memo = None
+        events = []
+        make_diversion = processor.make_diversion
+        def record_diversion(divnum):
+            events.append(('divert', divnum))
+            make_diversion(divnum)
+        processor.output_text = lambda text: events.append(('output', text))
+        processor.make_diversion = record_diversion
+        processor.call_macro = lambda macro, arguments: \
+            self.checked_call_macro(processor, macro, arguments)
+        first_call_id = processor.macro_call_id
+        block = Block(Block.INPUT_FILE, name, [text])
+        processor.push_block(block)
+        while True:
+            state = {'offset' : block.offset,
+                     'line' : block.line,
+                     'start_of_input_line' : block.start_of_input_line,
+                     'start_of_output_line' : processor.start_of_output_line,
+                     'output_current_line' : processor.output_current_line,
+                     'comments' : list(processor.comments),
+                     'macro_calls' : processor.macro_call_id - first_call_id}
+            mark = len(events)
+            try:
+                if self.snapshot.debug_level:
+                    raise DynamicConstruct() # traces are written while expanding
+                if not self.expand_span(processor, block):
+                    break
+            except Exception:
+                # dynamic construct, error or m4exit, the interpreter
+                # repeats it when rendering
+                del events[mark:]
+                break
+        return self.generate(name, events, state)
+
+    def checked_call_macro(self, processor, macro, arguments):
+        if macro.traced:
+            raise DynamicConstruct()
+        if macro.type == Macro.TOKEN_DATA_FUNC:
+            builtin = find_builtin_by_addr(macro.data)
+            if not builtin or builtin[0] not in self.STATIC_BUILTINS:
+                raise DynamicConstruct()
+        return type(processor).call_macro(processor, macro, arguments)
+
+    def expand_span(self, processor, block):
+        # Expand one top level token and everything its expansion reads,
+        # returns False at the end of the input.
+        while True:
+            (token, line) = processor.next_token()
+            if token.type == Token.TOKEN_EOF:
+                return False
+            processor.expand_token(token, line)
+            if self.at_boundary(processor, block):
+                return True
+
+    def at_boundary(self, processor, block):
+        # only the template's own input is left
+        if processor.stack and processor.stack[0] is not block:
+            return False
+        for other in processor.stack[1:]:
+            if other.type == Block.INPUT_MACRO or other.offset < len(other.content):
+                return False
+        return True
+
+    def generate(self, name, events, resume):
+        lines = ['# m4 template %s compiled by m4_compiler version %d' % \
+                     (name.replace('\n', ' '), self.VERSION),
+                 '',
+                 'RESUME = %r' % (resume,),
+                 '',
+                 'def render(output, divert):']
+        text = []
+        for (event, data) in events:
+            if event == 'output':
+                text.append(data)
+                continue
+            if text:
+                lines.append('    output(%r)' % ''.join(text))
+                text = []
+            lines.append('    divert(%r)' % (data,))
+        if text:
+            lines.append('    output(%r)' % ''.join(text))
+        lines.append('    return RESUME')
+        return '\n'.join(lines) + '\n'
+
+    def process_file(self, processor, filename):
+        # Same as processor.process_file (FILENAME) for a processor in the
+        # state of the snapshot.
+        filepath = processor.search_file(filename)
+        with open(filepath) as f:
+            text = f.read()
+        return self.process_text(processor, text, filename)
+
+    def process_text(self, processor, text, name):
+        template = self.get(text, name)
+        processor.start_budgets()
+        resume = template.function(processor.output_text, processor.make_diversion)
+        processor.push_file(name, [text])
+        block = processor.stack[-1]
+        block.offset = resume['offset']
+        block.line = resume['line']
+        block.start_of_input_line = resume['start_of_input_line']
+        processor.start_of_output_line = resume['start_of_output_line']
+        processor.output_current_line = resume['output_current_line']
+        processor.comments = list(resume['comments'])
+        processor.macro_call_id += resume['macro_calls']
+        return processor.expand_input()
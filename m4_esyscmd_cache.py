@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import hashlib
+
+
+class CommandCache(object):
+    # On-disk cache of esyscmd results. Entries are keyed by the command,
+    # the working directory, the values of ENV_NAMES and the mtime and
+    # size of the declared INPUTS. They expire after TTL seconds and the
+    # least recently used are evicted beyond MAX_SIZE bytes.
+    def __init__(self, directory, env_names=(), inputs=(), ttl=None, max_size=None):
+        self.directory = directory
+        self.env_names = list(env_names)
+        self.inputs = list(inputs)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, command):
+        inputs = []
+        for path in self.inputs:
+            try:
+                stat = os.stat(path)
+                inputs.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                inputs.append((path, None, None))
+        env = dict((name, os.environ.get(name)) for name in self.env_names)
+        data = json.dumps([command, os.getcwd(), env, inputs], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def lookup(self, command):
+        # Returns (returncode, output) or None.
+        path = self.entry_path(self.make_key(command))
+        try:
+            with open(path) as entry:
+                result = json.load(entry)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.time() - result['created'] > self.ttl:
+            self.remove(path)
+            self.misses += 1
+            return None
+        os.utime(path) # mark as recently used
+        self.hits += 1
+        return (result['returncode'], result['output'])
+
+    def store(self, command, returncode, output):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.entry_path(self.make_key(command))
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as entry:
+            json.dump({'command': command, 'returncode': returncode,
+                       'output': output, 'created': time.time()}, entry)
+        os.replace(temp_path, path)
+        if self.max_size is not None:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,184 @@
+import os
+import json
+import hashlib
+
+from m4_common import Macro, Token, Block
+from m4_builtin import find_builtin_by_addr, find_builtin_by_name
+
+
+class IncludeCache(object):
+    # On-disk cache of the macro table changes made by included files.
+    # Entries are keyed by the file content and the quote and comment
+    # state it was read with.
+    VERSION = 2
+
+    def __init__(self, processor, directory):
+        self.processor = processor
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        # side effects and macro lookups noticed while recording
+        self.recording = 0
+        self.side_effects = 0
+        self.consulted = set()
+
+    def make_key(self, content):
+        config = self.processor.config
+        digest = hashlib.sha256()
+        digest.update(('%d\0' % self.VERSION).encode('utf-8'))
+        for name in ('left_quote', 'right_quote', 'begin_comment', 'end_comment', \
+                     'word_regexp', 'no_gnu_extensions', 'prefix_all_builtins'):
+            digest.update(('%s\0' % config[name]).encode('utf-8'))
+        digest.update(content.encode('utf-8'))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, key):
+        try:
+            with open(self.entry_path(key)) as entry:
+                return json.load(entry)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, key, delta):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.entry_path(key)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as entry:
+            json.dump(delta, entry)
+        os.replace(temp_path, path)
+
+    def include(self, filename, filepath):
+        processor = self.processor
+        block = Block(Block.INPUT_FILE, filename, filepath)
+        if processor.hooks:
+            processor.emit('include', filename, filepath)
+        if not block.content.endswith('\n'):
+            # the last token could be joined with the following input
+            self.fallbacks += 1
+            processor.push_block(block)
+            return
+        key = self.make_key(block.content)
+        delta = self.load(key)
+        if delta is not None and self.satisfied(delta):
+            self.hits += 1
+            self.apply(delta)
+            return
+        self.misses += 1
+        self.record(key, block)
+
+    def record(self, key, block):
+        # Process the file eagerly at top level and remember how the
+        # macro table changed, unless it had any other visible effect.
+        processor = self.processor
+        # definition lists are never changed in place, identity tells changes
+        before = processor.macrostab.freeze()
+        quotes = self.quote_state()
+        diversion = processor.current_diversion
+        saved_side_effects = self.side_effects
+        saved_consulted = self.consulted
+        self.side_effects = 0
+        self.consulted = set()
+        self.recording += 1
+        saved_stack = processor.stack
+        processor.stack = [block]
+        try:
+            while True:
+                (token, line) = processor.next_token()
+                if token.type == Token.TOKEN_EOF:
+                    break
+                processor.expand_token(token, line)
+        finally:
+            processor.stack = saved_stack
+            self.recording -= 1
+            side_effects = self.side_effects
+            consulted = self.consulted
+            self.side_effects = saved_side_effects
+            self.consulted = saved_consulted | consulted
+        if side_effects or self.quote_state() != quotes or \
+           processor.current_diversion != diversion:
+            self.fallbacks += 1
+            return
+        delta = self.make_delta(before)
+        # the delta is only valid for the same definitions of the
+        # macros the file looked at
+        delta['require'] = dict((name, self.dump_macros(before.get(name)))
+                                for name in consulted)
+        self.store(key, delta)
+
+    def satisfied(self, delta):
+        macrostab = self.processor.macrostab
+        for name, dumps in delta['require'].items():
+            if self.dump_macros(macrostab.get(name)) != dumps:
+                return False
+        return True
+
+    def note_side_effect(self):
+        if self.recording:
+            self.side_effects += 1
+
+    def note_lookup(self, name):
+        if self.recording:
+            self.consulted.add(name)
+
+    def quote_state(self):
+        config = self.processor.config
+        return (config['left_quote'], config['right_quote'],
+                config['begin_comment'], config['end_comment'], config['word_regexp'])
+
+    def make_delta(self, before):
+        macrostab = self.processor.macrostab
+        delta = {'define': {}, 'undefine': []}
+        for name, macros in macrostab.items():
+            old_macros = before.get(name)
+            if old_macros is not None and len(old_macros) == len(macros) and \
+               all(old is new for old, new in zip(old_macros, macros)):
+                continue
+            delta['define'][name] = self.dump_macros(macros)
+        for name in before:
+            if name not in macrostab:
+                delta['undefine'].append(name)
+        return delta
+
+    def dump_macros(self, macros):
+        if not macros:
+            return None
+        return [self.dump_macro(macro) for macro in macros]
+
+    def dump_macro(self, macro):
+        if macro.type == Macro.TOKEN_DATA_FUNC:
+            builtin = find_builtin_by_addr(macro.data)
+            return {'builtin': builtin[0], 'traced': macro.traced}
+        return {'text': macro.data, 'help': macro.help, 'traced': macro.traced}
+
+    def apply(self, delta):
+        processor = self.processor
+        for name in delta['undefine']:
+            if name in processor.macrostab:
+                del processor.macrostab[name]
+                processor.macro_changed(name)
+        for name, definitions in delta['define'].items():
+            macros = []
+            for definition in definitions:
+                macro = Macro()
+                macro.name = name
+                macro.traced = definition['traced']
+                if 'builtin' in definition:
+                    (dummy, gnu_extension, groks_macro_args, blind_if_no_args, func) = \
+                        find_builtin_by_name(definition['builtin'])
+                    macro.type = Macro.TOKEN_DATA_FUNC
+                    macro.data = func
+                    macro.macro_args = groks_macro_args
+                    macro.blind_no_args = blind_if_no_args
+                else:
+                    macro.type = Macro.TOKEN_DATA_TEXT
+                    macro.data = definition['text']
+                    macro.help = definition['help']
+                macros.append(macro)
+            processor.macro_changed(name)
+            processor.macrostab[name] = macros
+
@@ -0,0 +1,164 @@
+import re
+from collections import OrderedDict
+
+from m4_common import Macro
+from m4_builtin import find_builtin_by_addr, pure_builtin_tab
+
+
+class MemoAbort(Exception):
+    # Raised while rescanning a memoized expansion in isolation when the
+    # result can't be cached: an impure macro was reached or the scanner
+    # needed to look past the end of the expansion.
+    pass
+
+
+class MacroMemo(object):
+    # LRU cache of fully rescanned expansions of pure user macros.
+    WORD_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+    def __init__(self, processor, size=1024, allowlist=()):
+        self.processor = processor
+        self.size = size
+        self.allowlist = set(allowlist)
+        # (name, generation, quotes, safe_boundary, arguments) -> rescanned text
+        self.entries = OrderedDict()
+        self.entries_by_name = {}
+        # words looked up while rescanning an entry: the expansion may
+        # reach macros through its arguments, not only through its body
+        self.entry_words = {}
+        self.entries_by_word = {}
+        # words looked up by the rescans in progress, innermost last
+        self.collecting = []
+        # name -> (generation, pure)
+        self.verdicts = {}
+        # dependency name -> names of macros whose verdict relies on it
+        self.dependents = {}
+        # name -> [hits, misses, aborts]
+        self.stats = {}
+
+    def is_pure_macro(self, macro):
+        if macro.name in self.allowlist:
+            return True
+        if macro.type == Macro.TOKEN_DATA_FUNC:
+            builtin = find_builtin_by_addr(macro.data)
+            return builtin is not None and builtin[0] in pure_builtin_tab
+        if macro.type != Macro.TOKEN_DATA_TEXT:
+            return False
+        return self.analyse(macro.name, set())
+
+    def analyse(self, name, visiting):
+        # A user macro is pure if every defined word in its body is pure.
+        # Undefined words are recorded as dependencies, defining them
+        # later invalidates the verdict.
+        generation = self.processor.macro_generation.get(name, 0)
+        verdict = self.verdicts.get(name)
+        if verdict is not None and verdict[0] == generation:
+            return verdict[1]
+        if name in visiting:
+            return True # recursion, purity is decided by the other words
+        macro = self.processor.lookup_macro(name)
+        if macro is None:
+            return True
+        if name in self.allowlist:
+            return True
+        if macro.type == Macro.TOKEN_DATA_FUNC:
+            builtin = find_builtin_by_addr(macro.data)
+            return builtin is not None and builtin[0] in pure_builtin_tab
+        if macro.type != Macro.TOKEN_DATA_TEXT:
+            return False
+        visiting.add(name)
+        pure = True
+        for word in set(self.WORD_PATTERN.findall(macro.data)):
+            self.dependents.setdefault(word, set()).add(name)
+            if pure and not self.analyse(word, visiting):
+                pure = False
+        visiting.discard(name)
+        self.verdicts[name] = (generation, pure)
+        return pure
+
+    def invalidate(self, name):
+        # Drop cached results of NAME and of everything depending on it.
+        pending = [name]
+        seen = set()
+        while pending:
+            current = pending.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            self.verdicts.pop(current, None)
+            for key in list(self.entries_by_name.get(current, ())):
+                self.drop(key)
+            for key in list(self.entries_by_word.get(current, ())):
+                self.drop(key)
+            pending.extend(self.dependents.pop(current, ()))
+
+    def drop(self, key):
+        self.entries.pop(key, None)
+        keys = self.entries_by_name.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.entries_by_name[key[0]]
+        for word in self.entry_words.pop(key, ()):
+            keys = self.entries_by_word.get(word)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.entries_by_word[word]
+
+    def begin_rescan(self):
+        self.collecting.append(set())
+
+    def end_rescan(self):
+        # Returns the words looked up by the rescan, which the enclosing
+        # rescan depends on as well.
+        words = self.collecting.pop()
+        if self.collecting:
+            self.collecting[-1] |= words
+        return words
+
+    def note_word(self, word):
+        self.collecting[-1].add(word)
+
+    def make_key(self, macro, arguments, safe_boundary):
+        config = self.processor.config
+        generation = self.processor.macro_generation.get(macro.name, 0)
+        quotes = (config['left_quote'], config['right_quote'],
+                  config['begin_comment'], config['end_comment'])
+        return (macro.name, generation, quotes, safe_boundary, arguments)
+
+    def lookup(self, key):
+        counters = self.stats.setdefault(key[0], [0, 0, 0])
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            counters[0] += 1
+            if self.collecting:
+                self.collecting[-1] |= self.entry_words[key]
+            return self.entries[key]
+        counters[1] += 1
+        return None
+
+    def store(self, key, text, words):
+        self.entries[key] = text
+        self.entries_by_name.setdefault(key[0], set()).add(key)
+        self.entry_words[key] = words
+        for word in words:
+            self.entries_by_word.setdefault(word, set()).add(key)
+        while len(self.entries) > self.size:
+            self.drop(next(iter(self.entries)))
+
+    def abort(self, name):
+        self.stats.setdefault(name, [0, 0, 0])[2] += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.entries_by_name.clear()
+        self.entry_words.clear()
+        self.entries_by_word.clear()
+        self.verdicts.clear()
+        self.dependents.clear()
+
+    def report(self):
+        # per macro statistics: name -> {'hits', 'misses', 'aborts'}
+        return dict((name, {'hits': hits, 'misses': misses, 'aborts': aborts})
+                    for name, (hits, misses, aborts) in self.stats.items())
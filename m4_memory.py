@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import heapq
+import resource
+import tracemalloc
+
+from m4_common import Block, Macro
+
+
+class MemoryReport(object):
+    # Memory use of a processor by phase: the peak of the allocations
+    # traced by tracemalloc, the allocations of the m4 modules still alive
+    # at the end of the phase and the size of the processor's own
+    # structures. Like the profiler the input stack and arguments are
+    # watched through methods shadowing the processor's own between
+    # start () and stop (), which also start the undivert phase at the
+    # end of input.
+    SOURCES = ('m4_common.py', 'm4_processor.py', 'm4_builtin.py')
+    SHADOWED = ('push_block', 'collect_arguments', 'undivert_at_end')
+    BLOCK_TYPES = ['string', 'file', 'macro']
+
+    def __init__(self, processor, top=10):
+        self.processor = processor
+        self.top = top
+        self.phases = []
+        self.phase = None
+        self.saved = {}
+        self.tracing = False
+        self.peak_depth = 0
+        self.deepest_blocks = [] # innermost blocks at the peak depth
+        self.largest_blocks = [] # heap of (chars, count, description)
+        self.pushed_blocks = 0
+        self.largest_arguments = {} # macro name -> chars of its largest call
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        processor = self.processor
+        for name in self.SHADOWED:
+            self.saved[name] = getattr(processor, name)
+            setattr(processor, name, getattr(self, name))
+
+    def stop(self):
+        self.end_phase()
+        processor = self.processor
+        for name in self.SHADOWED:
+            if processor.__dict__.get(name) == getattr(self, name):
+                del processor.__dict__[name]
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def begin_phase(self, name):
+        self.end_phase()
+        tracemalloc.reset_peak()
+        self.phase = {'name' : name,
+                      'start' : time.perf_counter(),
+                      'start_bytes' : tracemalloc.get_traced_memory()[0]}
+
+    def end_phase(self):
+        phase = self.phase
+        if phase is None:
+            return
+        self.phase = None
+        (current, peak) = tracemalloc.get_traced_memory()
+        phase['seconds'] = time.perf_counter() - phase.pop('start')
+        phase['end_bytes'] = current
+        phase['peak_bytes'] = peak
+        phase['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        phase['hotspots'] = self.hotspots()
+        phase['diversions'] = self.diversions()
+        phase['macros'] = self.macros()
+        self.phases.append(phase)
+
+    def push_block(self, block):
+        self.saved['push_block'](block)
+        self.pushed_blocks += 1
+        stack = self.processor.stack
+        if len(stack) > self.peak_depth:
+            self.peak_depth = len(stack)
+            first = max(len(stack) - self.top, 0)
+            self.deepest_blocks = [self.describe(stack[index], index + 1)
+                                   for index in range(first, len(stack))]
+        if block.type != Block.INPUT_MACRO:
+            size = len(block.content)
+            if len(self.largest_blocks) < self.top or size > self.largest_blocks[0][0]:
+                heapq.heappush(self.largest_blocks,
+                               (size, self.pushed_blocks, self.describe(block, len(stack))))
+                if len(self.largest_blocks) > self.top:
+                    heapq.heappop(self.largest_blocks)
+
+    def collect_arguments(self, name):
+        arguments = self.saved['collect_arguments'](name)
+        size = sum(len(argument) for argument in arguments[1:] if isinstance(argument, str))
+        if size > self.largest_arguments.get(name, 0):
+            self.largest_arguments[name] = size
+        return arguments
+
+    def undivert_at_end(self):
+        self.begin_phase('undivert')
+        self.saved['undivert_at_end']()
+
+    def describe(self, block, depth):
+        return {'type' : self.BLOCK_TYPES[block.type - Block.INPUT_STRING],
+                'file' : block.name,
+                'line' : block.line,
+                'macro' : block.macro,
+                'chars' : len(block.content) if block.type != Block.INPUT_MACRO else 0,
+                'depth' : depth}
+
+    def hotspots(self):
+        # allocations of the m4 modules alive at the end of the phase
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(True, '*' + source) for source in self.SOURCES])
+        return [{'file' : os.path.basename(stat.traceback[0].filename),
+                 'line' : stat.traceback[0].lineno,
+                 'bytes' : stat.size,
+                 'count' : stat.count}
+                for stat in snapshot.statistics('lineno')[:self.top]]
+
+    def diversions(self):
+        diversions = self.processor.diversions
+        largest = sorted(diversions.items(), key=lambda item: -len(item[1]))[:self.top]
+        return {'count' : len(diversions),
+                'chars' : sum(len(text) for text in diversions.values()),
+                'largest' : [{'diversion' : divnum, 'chars' : len(text),
+                              'bytes' : sys.getsizeof(text)} for (divnum, text) in largest]}
+
+    def macros(self):
+        macrostab = self.processor.macrostab
+        bodies = []
+        definitions = 0
+        for name in macrostab:
+            for (index, macro) in enumerate(macrostab[name]):
+                definitions += 1
+                if macro.type == Macro.TOKEN_DATA_TEXT:
+                    bodies.append((len(macro.data), name, index))
+        bodies.sort(reverse=True)
+        return {'names' : len(macrostab),
+                'definitions' : definitions,
+                'body_chars' : sum(body[0] for body in bodies),
+                'largest' : [{'name' : name, 'pushdef_depth' : index, 'chars' : size}
+                             for (size, name, index) in bodies[:self.top]]}
+
+    def report(self):
+        arguments = sorted(self.largest_arguments.items(), key=lambda item: -item[1])
+        return {'phases' : self.phases,
+                'stack' : {'peak_depth' : self.peak_depth,
+                           'pushed_blocks' : self.pushed_blocks,
+                           'deepest' : self.deepest_blocks,
+                           'largest' : [block for (size, count, block) in
+                                        sorted(self.largest_blocks, reverse=True)]},
+                'arguments' : [{'macro' : name, 'chars' : size}
+                               for (name, size) in arguments[:self.top]]}
+
+    def write_report(self, stream):
+        report = self.report()
+        stream.write("%-10s %9s %12s %12s %12s %10s\n" % \
+            ('phase', 'seconds', 'peak KB', 'start KB', 'end KB', 'rss KB'))
+        for phase in report['phases']:
+            stream.write("%-10s %9.3f %12d %12d %12d %10d\n" % \
+                (phase['name'], phase['seconds'], phase['peak_bytes'] // 1024,
+                 phase['start_bytes'] // 1024, phase['end_bytes'] // 1024, phase['max_rss_kb']))
+        for phase in report['phases']:
+            stream.write("\n%s: %d diversions, %d chars; %d macros, %d definitions, %d body chars\n" % \
+                (phase['name'], phase['diversions']['count'], phase['diversions']['chars'],
+                 phase['macros']['names'], phase['macros']['definitions'],
+                 phase['macros']['body_chars']))
+            for diversion in phase['diversions']['largest']:
+                stream.write("  diversion %-8s %12d chars\n" % \
+                    (diversion['diversion'], diversion['chars']))
+            for macro in phase['macros']['largest']:
+                stream.write("  macro %-24s %10d chars\n" % (macro['name'], macro['chars']))
+            for hotspot in phase['hotspots']:
+                stream.write("  %s:%-6d %12d bytes %8d blocks\n" % \
+                    (hotspot['file'], hotspot['line'], hotspot['bytes'], hotspot['count']))
+        stack = report['stack']
+        stream.write("\ninput stack: peak depth %d, %d blocks pushed\n" % \
+            (stack['peak_depth'], stack['pushed_blocks']))
+        for (title, blocks) in (('innermost at peak depth', stack['deepest']),
+                                ('largest', stack['largest'])):
+            stream.write("  %s:\n" % title)
+            for block in blocks:
+                stream.write("    %-6s %8d chars depth %-5d %s:%d%s\n" % \
+                    (block['type'], block['chars'], block['depth'], block['file'], block['line'],
+                     ' (%s)' % block['macro'] if block['macro'] else ''))
+        if report['arguments']:
+            stream.write("\nlargest arguments:\n")
+            for argument in report['arguments']:
+                stream.write("  %-24s %10d chars\n" % (argument['macro'], argument['chars']))
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
@@ -0,0 +1,172 @@
+import os
+import time
+import json
+import threading
+
+
+class Metrics(object):
+    # Counters and gauges of a running processor. Like the profiler the
+    # instrumented methods shadow the processor's own only between
+    # start () and stop (), a processor without metrics pays nothing.
+    TOKEN_NAMES = ['eof', 'string', 'word', 'open', 'comma', 'close', 'simple', 'macdef']
+    SHADOWED = ('push_string', 'output_text', 'run_command')
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.tokens = [0] * len(self.TOKEN_NAMES)
+        self.push_string_blocks = 0
+        self.peak_expansion_level = 0
+        self.diversion_bytes = {}
+        self.esyscmd_count = 0
+        self.esyscmd_seconds = 0.0
+        self.syscmd_count = 0
+        self.syscmd_seconds = 0.0
+        self.first_call_id = processor.macro_call_id
+        self.saved = {}
+        self.writer = None
+        self.stopped = threading.Event()
+
+    def start(self, path=None, format='json', interval=None):
+        # With PATH the metrics are written there by stop () and, with
+        # INTERVAL, every INTERVAL seconds meanwhile.
+        processor = self.processor
+        for name in self.SHADOWED:
+            self.saved[name] = getattr(processor, name)
+            setattr(processor, name, getattr(self, name))
+        processor.subscribe('token', self.token)
+        processor.subscribe('macro_enter', self.macro_enter)
+        self.path = path
+        self.format = format
+        if path and interval:
+            self.stopped.clear()
+            self.writer = threading.Thread(target=self.write_periodically, args=(interval,),
+                                           name='m4-metrics', daemon=True)
+            self.writer.start()
+
+    def stop(self):
+        processor = self.processor
+        for name in self.SHADOWED:
+            if processor.__dict__.get(name) == getattr(self, name):
+                del processor.__dict__[name]
+        processor.unsubscribe('token', self.token)
+        processor.unsubscribe('macro_enter', self.macro_enter)
+        if self.writer is not None:
+            self.stopped.set()
+            self.writer.join()
+            self.writer = None
+        if self.path:
+            self.write(self.path, self.format)
+
+    def token(self, token, line):
+        self.tokens[token.type] += 1
+
+    def macro_enter(self, name, arguments):
+        if self.processor.expansion_level > self.peak_expansion_level:
+            self.peak_expansion_level = self.processor.expansion_level
+
+    def push_string(self, string, macro=None):
+        block = self.processor.current_block()
+        self.saved['push_string'](string, macro)
+        # short strings are merged into the current block
+        if self.processor.current_block() is not block:
+            self.push_string_blocks += 1
+
+    def output_text(self, text):
+        divnum = self.processor.current_diversion
+        if divnum >= 0: # negative diversions discard their text
+            self.diversion_bytes[divnum] = self.diversion_bytes.get(divnum, 0) + len(text)
+        self.saved['output_text'](text)
+
+    def run_command(self, command, capture):
+        start = time.perf_counter()
+        try:
+            return self.saved['run_command'](command, capture)
+        finally:
+            if capture:
+                self.esyscmd_count += 1
+                self.esyscmd_seconds += time.perf_counter() - start
+            else:
+                self.syscmd_count += 1
+                self.syscmd_seconds += time.perf_counter() - start
+
+    def collect(self):
+        processor = self.processor
+        metrics = {'tokens' : dict(zip(self.TOKEN_NAMES, self.tokens)),
+                   'macro_expansions' : processor.macro_call_id - self.first_call_id,
+                   'push_string_blocks' : self.push_string_blocks,
+                   'stack_depth' : len(processor.stack),
+                   'peak_stack_depth' : processor.peak_stack_depth,
+                   'peak_expansion_level' : self.peak_expansion_level,
+                   'diversion_bytes' : dict((str(divnum), size) for (divnum, size) in
+                                            sorted(self.diversion_bytes.items())),
+                   'esyscmd_count' : self.esyscmd_count,
+                   'esyscmd_seconds' : self.esyscmd_seconds,
+                   'syscmd_count' : self.syscmd_count,
+                   'syscmd_seconds' : self.syscmd_seconds}
+        if processor.include_cache is not None:
+            metrics['include_cache_hits'] = processor.include_cache.hits
+            metrics['include_cache_misses'] = processor.include_cache.misses
+            metrics['include_cache_fallbacks'] = processor.include_cache.fallbacks
+        if processor.esyscmd_cache is not None:
+            metrics['esyscmd_cache_hits'] = processor.esyscmd_cache.hits
+            metrics['esyscmd_cache_misses'] = processor.esyscmd_cache.misses
+        return metrics
+
+    def prometheus_text(self):
+        # text exposition format, as read by the node exporter's
+        # textfile collector
+        metrics = self.collect()
+        lines = []
+        def add(name, type, help, samples):
+            lines.append('# HELP m4_%s %s' % (name, help))
+            lines.append('# TYPE m4_%s %s' % (name, type))
+            for (labels, value) in samples:
+                lines.append('m4_%s%s %s' % (name, labels, value))
+        add('tokens_total', 'counter', 'Tokens read by type.',
+            [('{type="%s"}' % name, count) for (name, count) in metrics['tokens'].items()])
+        add('diversion_bytes_total', 'counter', 'Bytes of text output per diversion.',
+            [('{diversion="%s"}' % divnum, size)
+             for (divnum, size) in metrics['diversion_bytes'].items()])
+        for (key, name, type, help) in (
+                ('macro_expansions', 'macro_expansions_total', 'counter',
+                 'Macro calls expanded.'),
+                ('push_string_blocks', 'push_string_blocks_total', 'counter',
+                 'Input blocks pushed for expansions to rescan.'),
+                ('stack_depth', 'stack_depth', 'gauge', 'Current input stack depth.'),
+                ('peak_stack_depth', 'peak_stack_depth', 'gauge', 'Largest input stack depth.'),
+                ('peak_expansion_level', 'peak_expansion_level', 'gauge',
+                 'Deepest nesting of macro calls.'),
+                ('esyscmd_count', 'esyscmd_total', 'counter', 'Commands run by esyscmd.'),
+                ('esyscmd_seconds', 'esyscmd_seconds_total', 'counter',
+                 'Time spent running esyscmd commands.'),
+                ('syscmd_count', 'syscmd_total', 'counter', 'Commands run by syscmd.'),
+                ('syscmd_seconds', 'syscmd_seconds_total', 'counter',
+                 'Time spent running syscmd commands.'),
+                ('include_cache_hits', 'include_cache_hits_total', 'counter',
+                 'Includes replayed from the cache.'),
+                ('include_cache_misses', 'include_cache_misses_total', 'counter',
+                 'Includes recorded in the cache.'),
+                ('include_cache_fallbacks', 'include_cache_fallbacks_total', 'counter',
+                 'Includes the cache could not handle.'),
+                ('esyscmd_cache_hits', 'esyscmd_cache_hits_total', 'counter',
+                 'esyscmd results found in the cache.'),
+                ('esyscmd_cache_misses', 'esyscmd_cache_misses_total', 'counter',
+                 'esyscmd results not in the cache.')):
+            if key in metrics:
+                add(name, type, help, [('', metrics[key])])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        # written atomically, readers never see a partial file
+        if format == 'prometheus':
+            text = self.prometheus_text()
+        else:
+            text = json.dumps(self.collect(), indent=1) + '\n'
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+    def write_periodically(self, interval):
+        while not self.stopped.wait(interval):
+            self.write(self.path, self.format)
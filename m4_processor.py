@@ -1,9 +1,47 @@
 import sys
 import os
+import re
+import copy
+import json
+import time
 import argparse
-
-from m4_common import Macro, Token, Block
-from m4_builtin import builtin_init, find_builtin_by_addr
+import subprocess
+
+from m4_common import Macro, Token, Block, StreamBlock, OutputBuffer, SharedDict, M4Exit, \
+                      BudgetExceeded
+from m4_builtin import builtin_init, find_builtin_by_addr, side_effect_builtin_tab, \
+    state_builtin_tab, normalize_regexp
+from m4_memo import MacroMemo, MemoAbort
+from m4_include_cache import IncludeCache
+from m4_shell_pool import ShellPool
+from m4_esyscmd_cache import CommandCache
+from m4_trace import TraceWriter
+
+
+class ProcessorSnapshot(object):
+    # Frozen processor state. Macro tables are shared with the processor
+    # and with every fork made from the snapshot.
+    def __init__(self, processor):
+        self.macrostab = processor.macrostab.freeze()
+        self.macro_generation = processor.macro_generation.freeze()
+        self.config = dict(processor.config)
+        self.diversions = dict(processor.diversions)
+        self.current_diversion = processor.current_diversion
+        self.start_of_output_line = processor.start_of_output_line
+        self.output_current_line = processor.output_current_line
+        self.macro_call_id = processor.macro_call_id
+        self.returncode = processor.returncode
+        self.debug_level = processor.debug_level
+        self.debug_file = processor.debug_file
+        self.comments = list(processor.comments)
+        self.dependencies = dict(processor.dependencies)
+        self.wrap_queue = list(processor.wrap_queue)
+        self.shell_pool = processor.shell_pool
+
+    def fork(self, output=None, error=None):
+        processor = M4Processor(self.config, output, error, builtins=False)
+        processor.restore(self)
+        return processor
 
 
 class M4Processor(object):
@@ -12,7 +50,9 @@ class M4Processor(object):
     DEF_BCOMM = "#"
     DEF_ECOMM = "\n"
 
-    def __init__(self, config={}):
+    # OUTPUT receives diversion 0, ERROR errprint and trace output. Both
+    # default to sys.stdout and sys.stderr at the time of writing.
+    def __init__(self, config=None, output=None, error=None, builtins=True):
         self.stack = []
         self.config = {'left_quote' : self.DEF_LQUOTE,
                        'right_quote' : self.DEF_RQUOTE,
@@ -21,36 +61,116 @@ class M4Processor(object):
                        'sync_output' : True,
                        'nesting_limit': 300,
                        'no_gnu_extensions' : False,
-                       'prefix_all_builtins' : False}
-        self.config.update(config)
+                       'wrap_order' : 'lifo',
+                       'word_regexp' : None,
+                       'prefix_all_builtins' : False,
+                       'memoize' : False,
+                       'memoize_size' : 1024,
+                       'pure_macros' : (),
+                       'include_cache_dir' : None,
+                       'syscmd_timeout' : None,
+                       'shell_pool' : 0,
+                       'esyscmd_cache_dir' : None,
+                       'esyscmd_cache_env' : (),
+                       'esyscmd_inputs' : (),
+                       'esyscmd_cache_ttl' : None,
+                       'esyscmd_cache_size' : None,
+                       'max_macro_calls' : None,
+                       'max_pushed_bytes' : None,
+                       'max_diversion_bytes' : None,
+                       'time_limit' : None,
+                       'debug_mode' : None,
+                       'debug_file' : None,
+                       'trace_format' : 'text',
+                       'trace_max_size' : None,
+                       'trace_backups' : 0}
+        if config:
+            self.config.update(config)
         self.start_of_output_line = True
         self.output_current_line = -1
+        # stream for diversion 0, sys.stdout if None
+        self.output_stream = output
+        # stream for errors and traces, sys.stderr if None
+        self.error_stream = error
+        # code passed to m4exit, None while processing may go on
+        self.exit_code = None
         # Current recursion level in expand_macro ()
         self.expansion_level = 0
         # The number of the current call of expand_macro ().
         self.macro_call_id = 0
         # my debug
         self.debug = False
+        # event -> callbacks, see subscribe ()
+        self.hooks = {}
         # diversions ()
         self.diversions = {}
         self.current_diversion = 0
-        # debug stuff
+        # debug stuff, initially as set by --debugmode and --debugfile
         self.debug_level = 0
-        self.debug_file = None
+        self.debug_file = self.config['debug_file']
+        self.debug_stream = None
+        if self.config['debug_mode'] is not None:
+            self.set_debug_level(self.config['debug_mode'])
         # esycmd and syscmd
         # Exit code from last "syscmd" command.
         self.returncode = 0
+        # runs esyscmd and syscmd commands when set, e.g. by the asyncio
+        # front end: (command, capture) -> (exit code, output, stderr)
+        self.command_runner = None
+        # shell coprocesses, shared with forks
+        self.shell_pool = None
+        # results of esyscmd kept between runs
+        self.esyscmd_cache = None
+        if self.config['esyscmd_cache_dir']:
+            self.esyscmd_cache = CommandCache(self.config['esyscmd_cache_dir'], \
+                self.config['esyscmd_cache_env'], self.config['esyscmd_inputs'], \
+                self.config['esyscmd_cache_ttl'], self.config['esyscmd_cache_size'])
         # doc comments
         self.comments = []
-        # Init builtin macros
-        self.init_buitlin()
+        # files read or probed: path -> True if it exists
+        self.dependencies = {}
+        # text saved by m4wrap, in the order of the calls
+        self.wrap_queue = []
+        # memoization of pure user macros
+        self.macro_generation = SharedDict()
+        self.memo = None
+        if self.config['memoize']:
+            self.memo = MacroMemo(self, self.config['memoize_size'], \
+                                  self.config['pure_macros'])
+        # word syntax set by changeword, None for the default one
+        self.set_word_regexp(self.config['word_regexp'])
+        # Nesting of isolated rescans of memoized expansions
+        self.memo_depth = 0
+        self.memo_safe_boundary = False
+        # text shipped by the innermost isolated rescan, see memo_ship ()
+        self.memo_segments = None
+        self.memo_line_start = False
+        # cache of macro definitions made by included files
+        self.include_cache = None
+        if self.config['include_cache_dir']:
+            self.include_cache = IncludeCache(self, self.config['include_cache_dir'])
+        # largest depth of the input stack
+        self.peak_stack_depth = 0
+        # resource budgets of a run, see start_budgets ()
+        self.budgets = False
+        self.budget_first_call_id = 0
+        self.pushed_bytes = 0
+        self.diverted_bytes = 0
+        self.deadline = None
+        # Init builtin macros, a fork gets them from its snapshot
+        if builtins:
+            self.init_buitlin()
+        else:
+            self.macrostab = SharedDict()
 
     def init_buitlin(self):
-        self.macrostab = {}
+        self.macrostab = SharedDict()
         builtin_init(self, self.config['no_gnu_extensions'], \
                            self.config['prefix_all_builtins'])
 
     def find_macro_by_name(self, name):
+        if self.include_cache is not None:
+            self.include_cache.note_lookup(name)
         if name in self.macrostab and len(self.macrostab[name]) > 0:
             macro = self.macrostab[name][0]
             if macro.type == Macro.TOKEN_DATA_TEXT:
@@ -63,16 +183,48 @@ class M4Processor(object):
                 return macro
         return None
 
+    # Strings pushed on top of a string block with at most this many
+    # characters left are merged with it, when they are that short too.
+    MERGE_STRING_SIZE = 256
+
+    def push_block(self, block):
+        if block.name is not None:
+            block.file = block
+        elif len(self.stack) > 0:
+            block.file = self.stack[-1].file
+        self.stack.append(block)
+        if len(self.stack) > self.peak_stack_depth:
+            self.peak_stack_depth = len(self.stack)
+
     def push_file(self, filename, filepath):
         block = Block(Block.INPUT_FILE, filename, filepath)
-        self.stack.append(block)
+        self.push_block(block)
+        if self.hooks:
+            self.emit('include', filename, filepath)
 
-    def push_string(self, string):
+    def push_string(self, string, macro=None):
         current_block = self.current_block()
-        block = Block(Block.INPUT_STRING, string)
-        block.line = current_block.line if current_block else 1
-        block.name = current_block.name if current_block else None
-        self.stack.append(block)
+        if current_block and current_block.type == Block.INPUT_STRING and \
+           current_block.macro == macro and \
+           len(string) <= self.MERGE_STRING_SIZE and \
+           len(current_block.content) - current_block.offset <= self.MERGE_STRING_SIZE:
+            # the new block would get the same name and line; only the
+            # expansions of one macro are merged so every call in the
+            # stack keeps its block for budgets and the sampler
+            current_block.content = string + current_block.content[current_block.offset:]
+            current_block.offset = 0
+        else:
+            block = Block(Block.INPUT_STRING, string)
+            block.line = current_block.line if current_block else 1
+            block.name = current_block.name if current_block else None
+            block.macro = macro
+            block.call_id = self.macro_call_id
+            self.push_block(block)
+        if self.budgets:
+            self.pushed_bytes += len(string)
+            limit = self.config['max_pushed_bytes']
+            if limit is not None and self.pushed_bytes > limit:
+                self.budget_exceeded("Limit of %d bytes pushed for rescanning exceeded" % limit)
 
     def push_macro(self, func):
         current_block = self.current_block()
@@ -80,16 +232,13 @@ class M4Processor(object):
         block.line = current_block.line
         if current_block.name:
             block.name = current_block.name
-        self.stack.append(block)
+        self.push_block(block)
 
     def current_block(self):
         return self.stack[-1] if len(self.stack) > 0 else None
 
     def current_file(self):
-        index = len(self.stack) - 1
-        while index >= 0 and self.stack[index].name is None:
-            index -= 1
-        return self.stack[index] if index >= 0 else None
+        return self.stack[-1].file if len(self.stack) > 0 else None
 
     def pop_input(self):
         if len(self.stack) > 0:
@@ -105,6 +254,8 @@ class M4Processor(object):
                 if symbol != Block.CHAR_EOF:
                     return symbol
                 self.pop_input()
+        if self.memo_depth and not self.memo_safe_boundary:
+            raise MemoAbort()
         return Block.CHAR_EOF
 
     def next_symbol(self):
@@ -118,8 +269,14 @@ class M4Processor(object):
                 if symbol == Block.CHAR_EOF:
                     self.pop_input()
                     continue
-                else:
-                    return symbol
+                if block.offset >= len(block.content) and \
+                   block.type == Block.INPUT_STRING and len(self.stack) > 1:
+                    # drop exhausted strings at once, the block below has
+                    # the same name and line
+                    self.stack.pop()
+                return symbol
+        if self.memo_depth:
+            raise MemoAbort()
         return Block.CHAR_EOF
 
     def match_input(self, match, consume):
@@ -153,7 +310,8 @@ class M4Processor(object):
         elif self.match_input(self.config['begin_comment'], False):
             token = Token(Token.TOKEN_STRING)
         # word
-        elif symbol.isalpha() or symbol == '_':
+        elif (symbol.isalpha() or symbol == '_') if self.word_pattern is None \
+             else self.is_word_start(symbol):
             token = Token(Token.TOKEN_WORD)
         # quoted string
         elif self.match_input(self.config['left_quote'], False):
@@ -167,7 +325,8 @@ class M4Processor(object):
             token = Token(Token.TOKEN_CLOSE)
         else:
             token = Token(Token.TOKEN_SIMPLE)
-        self.debug_output("peek_token -> %s" % str(token))
+        if self.debug:
+            self.debug_output("peek_token -> %s", token)
         return (token, block.line if block else 0)
 
     def next_token(self):
@@ -176,7 +335,8 @@ class M4Processor(object):
         symbol = self.peek_symbol()
         # end of inputs
         if symbol == Block.CHAR_EOF:
-            self.debug_output("next_token -> EOF")
+            if self.debug:
+                self.debug_output("next_token -> EOF")
             self.next_symbol()
             return (Token(Token.TOKEN_EOF), block.line if block else 0)
         # macro found
@@ -189,7 +349,8 @@ class M4Processor(object):
             builtin = find_builtin_by_addr(token.data)
             if not builtin:
                 raise Exception("Unknown builtin, couldn't find it by address")
-            self.debug_output("next_token -> MACDEF (%s)" % builtin[0])
+            if self.debug:
+                self.debug_output("next_token -> MACDEF (%s)", builtin[0])
             return (token, block.line if block else 0)
         # comment
         token_data = self.match_input(self.config['begin_comment'], True)
@@ -210,14 +371,9 @@ class M4Processor(object):
                 token_type = Token.TOKEN_STRING
                 break
         # word
-        elif symbol.isalpha() or symbol == '_':
-            token_data = ''
-            # read whole word (identifier)
-            while True:
-                token_data += self.next_symbol()
-                next_symbol = self.peek_symbol()
-                if not next_symbol.isalnum() and next_symbol != '_':
-                    break
+        elif (symbol.isalpha() or symbol == '_') if self.word_pattern is None \
+             else self.is_word_start(symbol):
+            token_data = self.read_word()
             token_type = Token.TOKEN_WORD
         else:
         # quote	string
@@ -265,9 +421,76 @@ class M4Processor(object):
         token = Token(token_type)
         token.data_type = Macro.TOKEN_DATA_TEXT
         token.data = token_data
-        self.debug_output("next_token -> %s" % str(token))
+        if token_type == Token.TOKEN_WORD:
+            token.name = token_data if self.word_pattern is None else self.word_name(token_data)
+        if self.debug:
+            self.debug_output("next_token -> %s", token)
         return (token, block.line if block else 0)
 
+    def set_word_regexp(self, regexp=None):
+        # Word syntax of changeword, the default one for None or ''. A
+        # word is what the regexp matches, the macro it calls is named by
+        # the first group if there's one.
+        if regexp:
+            self.word_pattern = re.compile(normalize_regexp(regexp))
+        else:
+            regexp = None
+            self.word_pattern = None
+        self.config['word_regexp'] = regexp
+        self.word_starts = {}
+        if self.memo is not None:
+            self.memo.clear()
+
+    def is_word_start(self, symbol):
+        if self.word_pattern is None:
+            return symbol.isalpha() or symbol == '_'
+        start = self.word_starts.get(symbol)
+        if start is None:
+            start = self.word_starts[symbol] = \
+                len(symbol) == 1 and self.word_pattern.fullmatch(symbol) is not None
+        return start
+
+    WORD_TAIL = re.compile(r'\w*') # isalnum () or '_'
+
+    def read_word(self):
+        # Read the word starting at the next symbol, matched at once in
+        # the current block. A word reaching the end of the block goes on
+        # symbol by symbol while the regexp matches all of it, as in GNU.
+        block = self.current_block()
+        start = block.offset
+        if self.word_pattern is None:
+            end = self.WORD_TAIL.match(block.content, start + 1).end()
+        else:
+            match = self.word_pattern.match(block.content, start)
+            end = max(match.end() if match else 0, start + 1)
+        word = block.content[start:end]
+        block.next_symbol() # counts a pending new line
+        if '\n' in word:
+            for i in range(len(word) - 1):
+                block.next_symbol()
+        else:
+            block.offset = end
+        if end >= len(block.content):
+            while True:
+                symbol = self.peek_symbol()
+                if symbol == Block.CHAR_EOF or symbol == Block.CHAR_MACRO:
+                    break
+                if self.word_pattern is None:
+                    if not symbol.isalnum() and symbol != '_':
+                        break
+                elif self.word_pattern.fullmatch(word + symbol) is None:
+                    break
+                word += self.next_symbol()
+        return word
+
+    def word_name(self, word):
+        if self.word_pattern.groups == 0:
+            return word
+        match = self.word_pattern.fullmatch(word)
+        if match is None or match.group(1) is None:
+            return word
+        return match.group(1)
+
     def skip_line(self):
         block = self.current_block()
         ch = ch = self.next_symbol()
@@ -277,13 +500,134 @@ class M4Processor(object):
             raise Exception('Warning: end of file treated as newline')
 
     def process_file(self, filename):
+        # Returns the code passed to m4exit or None.
         filepath = self.search_file(filename)
+        self.start_budgets()
         self.push_file(filename, filepath)
-        while True:
-            (token, line) = self.next_token()
-            if token.type == Token.TOKEN_EOF:
-                break
-            self.expand_token(token, line)
+        return self.expand_input()
+
+    def process_stream(self, stream, name='-'):
+        # Like process_file () for a pipe or terminal: input is expanded
+        # as it arrives and the output is flushed before waiting for more.
+        self.start_budgets()
+        self.push_block(StreamBlock(name, stream, self.flush_output))
+        return self.expand_input()
+
+    def load_prelude(self, filename):
+        # Process FILENAME before the input proper: its output is
+        # discarded, its definitions and diversions are kept. Returns the
+        # code passed to m4exit or None.
+        filepath = self.search_file(filename)
+        if filepath is None:
+            raise Exception("cannot open '%s'" % filename)
+        with open(filepath) as f:
+            for chunk in self.iter_output(f, filename, undivert=False):
+                pass
+        return self.exit_code
+
+    def render(self, source, compiler=None):
+        # Process the file SOURCE, standard input for '-', as the command
+        # line does, through COMPILER if given. Returns the exit code,
+        # 1 if a budget was exceeded, and that error or None.
+        try:
+            if source == '-':
+                return (self.process_stream(sys.stdin), None)
+            if compiler:
+                return (compiler.process_file(self, source), None)
+            return (self.process_file(source), None)
+        except BudgetExceeded as e:
+            return (1, e)
+
+    def flush_output(self):
+        (self.output_stream or sys.stdout).flush()
+
+    def expand_input(self, undivert=True):
+        # Expand the input stack until it's empty, returns the code
+        # passed to m4exit or None.
+        try:
+            while True:
+                (token, line) = self.next_token()
+                if token.type == Token.TOKEN_EOF:
+                    if not undivert:
+                        break
+                    if self.push_wrapped():
+                        continue
+                    self.undivert_at_end()
+                    break
+                self.expand_token(token, line)
+        except M4Exit as e:
+            self.exit_code = e.code
+            del self.stack[:]
+            del self.wrap_queue[:]
+        return self.exit_code
+
+    def push_wrapped(self):
+        # At the end of input push the text saved by m4wrap back, last
+        # saved first as GNU m4 1.4 does or first saved first as POSIX
+        # requires. Text wrapped meanwhile is read after all of it.
+        # Returns False if there's none.
+        if not self.wrap_queue:
+            return False
+        chunks = self.wrap_queue
+        self.wrap_queue = []
+        if self.config['wrap_order'] == 'lifo':
+            chunks.reverse()
+        self.push_string(''.join(chunks))
+        return True
+
+    def undivert_at_end(self):
+        # Diversions left at the end of input are output in order, as in
+        # GNU m4. Not after m4exit, nor with UNDIVERT false for a prelude
+        # whose diversions and m4wrap text are kept for the input
+        # processed after it.
+        self.make_diversion('0')
+        self.undivert_all()
+
+    def process_string(self, text, name='-'):
+        # Process TEXT and return its output, diversions included.
+        return ''.join(self.iter_output([text], name))
+
+    def iter_output(self, source, name='-', chunk_size=8192, undivert=True):
+        # Process SOURCE (a file object or an iterable of text chunks) and
+        # yield output of diversion 0, then the diversions left at the
+        # end of input, in chunks of at most CHUNK_SIZE. Closing the
+        # generator early discards the rest of the input, so does m4exit,
+        # its code is left in exit_code.
+        buffer = OutputBuffer()
+        saved_output_stream = self.output_stream
+        depth = len(self.stack)
+        self.output_stream = buffer
+        self.start_budgets()
+        try:
+            self.push_file(name, source)
+            while True:
+                try:
+                    (token, line) = self.next_token()
+                    if token.type == Token.TOKEN_EOF:
+                        if not undivert:
+                            break
+                        if self.push_wrapped():
+                            continue
+                        self.undivert_at_end()
+                        break
+                    self.expand_token(token, line)
+                except M4Exit as e:
+                    self.exit_code = e.code
+                    del self.wrap_queue[:]
+                    break
+                if buffer.size >= chunk_size:
+                    text = buffer.take()
+                    offset = 0
+                    while len(text) - offset >= chunk_size:
+                        yield text[offset : offset + chunk_size]
+                        offset += chunk_size
+                    buffer.write(text[offset:])
+            text = buffer.take()
+            for offset in range(0, len(text), chunk_size):
+                yield text[offset : offset + chunk_size]
+        finally:
+            del self.stack[depth:]
+            self.output_stream = saved_output_stream
 
     def expand_token(self, token, line, prev_text=None):
         if token.type in [Token.TOKEN_EOF, Token.TOKEN_MACDEF]:
@@ -300,9 +644,15 @@ class M4Processor(object):
                 self.comments.append(comment)
             return self.shipout_text(token.data, line, prev_text)
         elif token.type == Token.TOKEN_WORD:
-            macro = self.find_macro_by_name(token.data)
+            if self.memo_depth:
+                self.memo.note_word(token.name)
+            macro = self.find_macro_by_name(token.name)
             if macro:
-                self.expand_macro(macro)
+                if self.memo_depth and not self.memo.is_pure_macro(macro):
+                    raise MemoAbort()
+                segments = self.expand_macro(macro, prev_text is not None)
+                if segments is not None: # memoized expansion, already rescanned
+                    return self.ship_segments(segments, prev_text)
                 return prev_text
             else:
                 return self.shipout_text(token.data, line, prev_text)
@@ -313,6 +663,9 @@ class M4Processor(object):
         # If output goes to an obstack, merely add TEXT to it.
         if prev_text is not None: # compose text without output
             return prev_text + text
+        if self.memo_depth:
+            self.memo_ship(text)
+            return None
         if self.current_diversion < 0:
             return
         # Do nothing if TEXT should be discarded.
@@ -339,13 +692,44 @@ class M4Processor(object):
                 self.start_of_output_line = True
         self.output_text(text)
 
+    def memo_ship(self, text):
+        # Collect the text shipped by an isolated rescan. A segment starts
+        # where the interpreter checks the sync line: with the first text
+        # shipped at the start of an output line.
+        if self.memo_line_start:
+            self.memo_segments.append(text)
+        else:
+            self.memo_segments[-1] += text
+        self.memo_line_start = text.endswith('\n')
+
+    def ship_segments(self, segments, prev_text):
+        # Ship a memoized expansion as the rescan of its pushed text does,
+        # segment by segment with the line of the block it's pushed on.
+        if prev_text is not None:
+            return prev_text + ''.join(segments)
+        block = self.current_block()
+        line = block.line if block else 1
+        for text in segments:
+            self.shipout_text(text, line)
+        return None
+
     def output_text(self, text):
         if self.current_diversion < 0:
             return
+        if text and self.include_cache is not None:
+            self.include_cache.note_side_effect()
         if self.current_diversion == 0:
-            sys.stdout.write(text)
-            sys.stdout.flush()
+            if self.output_stream is not None:
+                self.output_stream.write(text)
+            else:
+                sys.stdout.write(text)
+                sys.stdout.flush()
             return
+        if self.budgets:
+            self.diverted_bytes += len(text)
+            limit = self.config['max_diversion_bytes']
+            if limit is not None and self.diverted_bytes > limit:
+                self.budget_exceeded("Limit of %d diverted bytes exceeded" % limit)
         self.diversions[self.current_diversion] += text
 
     def make_diversion(self, divnum):
@@ -355,6 +739,8 @@ class M4Processor(object):
             return
 
         self.current_diversion = divnum
+        if self.hooks:
+            self.emit('divert', divnum)
 
         if divnum <= 0:
             return
@@ -365,10 +751,9 @@ class M4Processor(object):
         self.output_current_line = -1
 
     def undivert_all(self):
-        for divnum, text in self.diversions.items():
+        for divnum in sorted(self.diversions):
             if divnum != self.current_diversion:
-                self.output_text(text)
-                del self.diversions[divnum]
+                self.output_text(self.diversions.pop(divnum))
 
     def undivert(self, divnum):
         if (divnum[0] == '-' and divnum[1:].isdigit()) or divnum.isdigit():
@@ -377,7 +762,7 @@ class M4Processor(object):
             self.output_text(self.diversions[divnum])
             del self.diversions[divnum]
 
-    def expand_macro(self, macro):
+    def expand_macro(self, macro, in_argument=False):
         block = self.current_block()
         macro.pending_expansions += 1
         self.expansion_level += 1
@@ -385,26 +770,165 @@ class M4Processor(object):
             raise Exception("Recursion limit of %d exceeded" % self.config['nesting_limit'])
         self.macro_call_id += 1
         my_call_id = self.macro_call_id
+        if self.budgets:
+            self.check_budgets(macro.name)
 
         traced = (self.debug_level & self.DEBUG_TRACE_ALL) != 0 or macro.traced
         if traced and (self.debug_level & self.DEBUG_TRACE_CALL) != 0:
             self.trace_prepre(macro.name, my_call_id)
 
+        if self.include_cache is not None and self.include_cache.recording and \
+           macro.type == Macro.TOKEN_DATA_FUNC:
+            builtin = find_builtin_by_addr(macro.data)
+            if builtin and (builtin[0] in side_effect_builtin_tab or \
+                            builtin[0] in state_builtin_tab):
+                self.include_cache.note_side_effect()
+
         arguments = self.collect_arguments(macro.name)
         if traced:
             self.trace_pre(macro.name, my_call_id, arguments)
 
-        result = self.call_macro(macro, arguments)
-        if result:
-            self.debug_output("%s => %s" % (macro.name, result))
-            self.push_string(result)
+        memo_key = None
+        if self.memo is not None and not traced and not self.debug and \
+           self.word_pattern is None and \
+           macro.type == Macro.TOKEN_DATA_TEXT and self.memo.is_pure_macro(macro):
+            safe_boundary = self.memo_boundary_safe()
+            memo_key = self.memo.make_key(macro, arguments, safe_boundary)
+            segments = self.memo.lookup(memo_key)
+            # commas and parentheses of the rescanned text split arguments
+            if segments is not None and \
+               (not in_argument or not self.has_argument_syntax(segments)):
+                self.expansion_level -= 1
+                macro.pending_expansions -= 1
+                if self.hooks:
+                    self.emit('macro_enter', macro.name, arguments)
+                    self.emit('macro_exit', macro.name, ''.join(segments))
+                return segments
 
+        result = self.call_macro(macro, arguments)
         if traced:
             self.trace_post(macro.name, my_call_id, len(arguments), result)
 
         self.expansion_level -= 1
         macro.pending_expansions -= 1
 
+        if memo_key is not None:
+            (segments, words) = self.rescan_isolated(macro.name, result or '', safe_boundary)
+            if segments is not None:
+                self.memo.store(memo_key, segments, words)
+                if not in_argument or not self.has_argument_syntax(segments):
+                    return segments
+        if result:
+            if self.debug:
+                self.debug_output("%s => %s", macro.name, result)
+            self.push_string(result, macro.name)
+        return None
+
+    def start_budgets(self):
+        # Budgets count from the start of every process_file () and
+        # iter_output () run.
+        config = self.config
+        self.budgets = config['max_macro_calls'] is not None or \
+                       config['max_pushed_bytes'] is not None or \
+                       config['max_diversion_bytes'] is not None or \
+                       config['time_limit'] is not None
+        self.budget_first_call_id = self.macro_call_id
+        self.pushed_bytes = 0
+        self.diverted_bytes = 0
+        self.deadline = None
+        if config['time_limit'] is not None:
+            self.deadline = time.monotonic() + config['time_limit']
+
+    def check_budgets(self, name):
+        limit = self.config['max_macro_calls']
+        if limit is not None and self.macro_call_id - self.budget_first_call_id > limit:
+            self.budget_exceeded("Limit of %d macro calls exceeded" % limit, name)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.budget_exceeded("Time limit of %s seconds exceeded" % \
+                                 self.config['time_limit'], name)
+
+    def budget_exceeded(self, msg, name=None):
+        self.budgets = False # no further checks while unwinding
+        raise BudgetExceeded(msg, self.call_stack(name))
+
+    def call_stack(self, name=None):
+        # (macro, file, line) of the expansions being rescanned and of
+        # the macro NAME being called, innermost last.
+        call_stack = []
+        for block in self.stack:
+            if block.macro is not None:
+                call_stack.append((block.macro, block.name, block.line))
+        if name is not None:
+            block = self.current_file()
+            call_stack.append((name, block.name if block else None, block.line if block else 0))
+        return call_stack
+
+    def rescan_isolated(self, name, text, safe_boundary):
+        # Fully expand TEXT on its own input stack. Returns the expansion
+        # as a tuple of segments (see memo_ship ()), None when it isn't
+        # self-contained or reaches an impure macro, and the words looked
+        # up. With SAFE_BOUNDARY lookahead may stop at the end of TEXT.
+        current_block = self.current_block()
+        block = Block(Block.INPUT_STRING, text)
+        block.line = current_block.line if current_block else 1
+        block.name = current_block.name if current_block else None
+        saved_stack = self.stack
+        saved_safe_boundary = self.memo_safe_boundary
+        saved_segments = (self.memo_segments, self.memo_line_start)
+        self.memo_segments = ['']
+        self.memo_line_start = False
+        self.stack = []
+        self.push_block(block)
+        self.memo_depth += 1
+        self.memo_safe_boundary = safe_boundary
+        self.memo.begin_rescan()
+        try:
+            while not self.input_exhausted():
+                (token, line) = self.next_token()
+                self.expand_token(token, line)
+            expanded = tuple(self.memo_segments)
+        except MemoAbort:
+            self.memo.abort(name)
+            expanded = None
+        finally:
+            (self.memo_segments, self.memo_line_start) = saved_segments
+            self.stack = saved_stack
+            self.memo_depth -= 1
+            self.memo_safe_boundary = saved_safe_boundary
+            words = self.memo.end_rescan()
+        return (expanded, words)
+
+    def input_exhausted(self):
+        for block in self.stack:
+            if block.type == Block.INPUT_MACRO or block.offset < len(block.content):
+                return False
+        return True
+
+    def memo_boundary_safe(self):
+        # True if the input following an expansion can't be joined with
+        # its tail: no word, open parenthesis, quote or comment follows.
+        for block in reversed(self.stack):
+            if block.type == Block.INPUT_MACRO:
+                return False
+            if block.offset < len(block.content):
+                symbol = block.content[block.offset]
+                if symbol.isalnum() or symbol == '_' or symbol == '(':
+                    return False
+                for delimiter in ('left_quote', 'right_quote', \
+                                  'begin_comment', 'end_comment'):
+                    if symbol in self.config[delimiter]:
+                        return False
+                return True
+            if not block.complete:
+                return False # the next symbol hasn't arrived yet
+        return self.memo_safe_boundary if self.memo_depth else True
+
+    def has_argument_syntax(self, segments):
+        for text in segments:
+            if ',' in text or '(' in text or ')' in text:
+                return True
+        return False
+
     def collect_arguments(self, name):
         arguments = [name] # macro name always as first argument
         (next_token, _) = self.peek_token()
@@ -451,6 +975,8 @@ class M4Processor(object):
 
     def call_macro(self, macro, arguments):
         if macro.type == Macro.TOKEN_DATA_FUNC:
+            if self.debug:
+                self.debug_builtin_call(arguments)
             return macro.call(self, arguments)
         elif macro.type == Macro.TOKEN_DATA_TEXT:
             return self.expand_user_macro(macro, arguments)
@@ -466,7 +992,8 @@ class M4Processor(object):
             index = text.find('$', offset)
             if index == -1:
                 result += text[offset:]
-                self.debug_output("exapnd_user_macro %s -> %s" % (macro.name, result))
+                if self.debug:
+                    self.debug_output("exapnd_user_macro %s -> %s", macro.name, result)
                 return result
             result += text[offset : index]
             index += 1
@@ -493,7 +1020,40 @@ class M4Processor(object):
         else:
             return sep.join(real_arguments)
 
+    def run_command(self, command, capture):
+        # Run COMMAND with the shell for esyscmd (CAPTURE) and syscmd.
+        # Returns the exit code and for esyscmd the output, stderr
+        # included. The output of syscmd goes to the current diversion
+        # and its stderr to the error stream.
+        timeout = self.config['syscmd_timeout']
+        if self.command_runner is not None:
+            (returncode, output, errors) = self.command_runner(command, capture)
+        elif self.config['shell_pool'] > 0:
+            if self.shell_pool is None:
+                self.shell_pool = ShellPool(self.config['shell_pool'])
+            (returncode, output, errors) = self.shell_pool.run(command, capture, timeout)
+        else:
+            try:
+                completed = subprocess.run(command, shell=True, timeout=timeout, \
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT if capture else subprocess.PIPE)
+            except subprocess.TimeoutExpired:
+                raise Exception("Command '%s' timed out after %s seconds" % (command, timeout))
+            (returncode, output, errors) = (completed.returncode, completed.stdout.decode(), \
+                                            completed.stderr.decode() if completed.stderr else '')
+        if errors:
+            self.write_error(errors)
+        if capture:
+            return (returncode, output)
+        self.output_text(output)
+        return (returncode, None)
+
     def search_file(self, filename):
+        filepath = self.resolve_file(filename)
+        self.add_dependency(filepath if filepath is not None else filename, \
+                            filepath is not None and os.path.exists(filepath))
+        return filepath
+
+    def resolve_file(self, filename):
         if os.path.isabs(filename):
             return filename
         if filename[:2] == '.' + os.sep:
@@ -507,6 +1067,31 @@ class M4Processor(object):
                         return absfilepath
         return None
 
+    def add_dependency(self, path, exists=True):
+        if self.dependencies.get(path) is None or exists:
+            self.dependencies[path] = exists
+
+    def write_depfile(self, depfile, target, missing=False):
+        # Write a Makefile rule making TARGET depend on every file read.
+        # With MISSING unsuccessful probes are listed too, so the target
+        # is rebuilt once they appear (like -MG of cc).
+        def quote(path):
+            if os.path.isabs(path):
+                relpath = os.path.relpath(path)
+                if not relpath.startswith(os.pardir):
+                    path = relpath
+            return path.replace('$', '$$').replace(' ', '\\ ').replace('#', '\\#')
+        paths = [quote(path) for path, exists in self.dependencies.items() \
+                 if exists or missing]
+        with open(depfile, 'w') as f:
+            f.write('%s:' % quote(target))
+            for path in paths:
+                f.write(' \\\n  %s' % path)
+            f.write('\n')
+            # phony rules keep make going when a file disappears
+            for path in paths:
+                f.write('\n%s:\n' % path)
+
     def define_user_macro(self, name, text, mode = "insert"):
         macro = Macro()
         macro.name = name
@@ -516,12 +1101,14 @@ class M4Processor(object):
         if len(self.comments) > 0:
             macro.help = '\n'.join(self.comments)
             self.comments = []
+        self.macro_changed(macro.name)
         if mode == "insert":
             self.macrostab[macro.name] = [macro]
         elif mode == "pushdef":
-            if macro.name not in self.macrostab:
-                self.macrostab[macro.name] = []
-            self.macrostab[macro.name].insert(0, macro)
+            if self.include_cache is not None:
+                self.include_cache.note_lookup(macro.name)
+            # definition lists are shared with snapshots, never change them
+            self.macrostab[macro.name] = [macro] + self.macrostab.get(macro.name, [])
         else:
             raise Exception("Unknown mode '%s' for macro insertion" % mode)
 
@@ -533,29 +1120,90 @@ class M4Processor(object):
         macro.blind_no_args = blind_if_no_args
         macro.type = Macro.TOKEN_DATA_FUNC
         macro.data = func
+        self.macro_changed(macro.name)
         if mode == "insert":
             self.macrostab[macro.name] = [macro]
         elif mode == "pushdef":
-            if macro.name not in self.macrostab:
-                self.macrostab[macro.name] = []
-            self.macrostab[macro.name].insert(0, macro)
+            if self.include_cache is not None:
+                self.include_cache.note_lookup(macro.name)
+            # definition lists are shared with snapshots, never change them
+            self.macrostab[macro.name] = [macro] + self.macrostab.get(macro.name, [])
         else:
             raise Exception("Unknown mode '%s' for macro insertion" % mode)
 
 
     def lookup_macro(self, name, mode='lookup'):
+        if self.include_cache is not None:
+            self.include_cache.note_lookup(name)
         if name not in self.macrostab:
             return None
         if mode == 'lookup':
             return self.macrostab[name][0]
-        elif mode == 'delete':
-            self.macrostab[name].pop(0)
-            if len(self.macrostab[name]) == 0:
+        self.macro_changed(name)
+        if mode == 'delete':
+            macros = self.macrostab[name][1:]
+            if len(macros) == 0:
                 del self.macrostab[name]
+            else:
+                self.macrostab[name] = macros
         elif mode == 'popdef':
             del self.macrostab[name]
         return None
 
+    # snapshots
+
+    def snapshot(self):
+        # Capture the state between inputs, the input stack isn't saved.
+        return ProcessorSnapshot(self)
+
+    def restore(self, snapshot):
+        self.macrostab = SharedDict(snapshot.macrostab)
+        self.macro_generation = SharedDict(snapshot.macro_generation)
+        self.config = dict(snapshot.config)
+        self.set_word_regexp(self.config['word_regexp'])
+        self.diversions = dict(snapshot.diversions)
+        self.current_diversion = snapshot.current_diversion
+        self.start_of_output_line = snapshot.start_of_output_line
+        self.output_current_line = snapshot.output_current_line
+        self.macro_call_id = snapshot.macro_call_id
+        self.returncode = snapshot.returncode
+        self.debug_level = snapshot.debug_level
+        self.debug_set_output(snapshot.debug_file)
+        self.comments = list(snapshot.comments)
+        self.dependencies = dict(snapshot.dependencies)
+        self.wrap_queue = list(snapshot.wrap_queue)
+        if snapshot.shell_pool is not None:
+            self.shell_pool = snapshot.shell_pool
+        if self.memo is not None:
+            self.memo.clear()
+
+    def fork(self, snapshot=None, output=None, error=None):
+        # New processor starting from SNAPSHOT or from the current state.
+        if snapshot is None:
+            snapshot = self.snapshot()
+        return snapshot.fork(output, error)
+
+    def render_variants(self, text, variants, name='-', snapshot=None):
+        # Process TEXT once for every dictionary of definitions in
+        # VARIANTS, each in a fork of SNAPSHOT, and return the outputs.
+        if snapshot is None:
+            snapshot = self.snapshot()
+        outputs = []
+        for defines in variants:
+            processor = snapshot.fork()
+            for macro_name, value in defines.items():
+                processor.define_user_macro(macro_name, value)
+            outputs.append(processor.process_string(text, name))
+        return outputs
+
+    def macro_changed(self, name):
+        self.macro_generation[name] = self.macro_generation.get(name, 0) + 1
+        if self.memo is not None:
+            self.memo.invalidate(name)
+
+    def memo_stats(self):
+        return self.memo.report() if self.memo is not None else {}
+
      # debug stuff
 
     # The value of debug_level is a bitmask of the following.
@@ -642,15 +1290,35 @@ class M4Processor(object):
             raise Exception("INTERNAL ERROR: bad flag in m4_debugmode ()")
 
     def debug_set_output(self, filename = None):
+        if self.debug_stream is not None:
+            self.debug_stream.close()
+            self.debug_stream = None
         self.debug_file = filename
 
     def debug_print(self, msg):
-        msg = msg + "\n"
+        if self.config['trace_format'] == 'json':
+            msg = json.dumps({'event' : 'message', 'text' : msg})
+        self.debug_write(msg + "\n")
+
+    def debug_write(self, text):
         if self.debug_file is None:
+            self.write_error(text)
+        elif self.debug_file != '': # debugfile(`') discards traces
+            if self.debug_stream is None:
+                self.debug_stream = TraceWriter(self.debug_file, \
+                    self.config['trace_max_size'], self.config['trace_backups'])
+            self.debug_stream.write(text)
+
+    def write_error(self, msg):
+        if self.error_stream is not None:
+            self.error_stream.write(msg)
+        else:
             sys.stderr.write(msg)
             sys.stderr.flush()
-        else:
-            open(self.debug_file, "a").write(msg)
+
+    def close(self):
+        # Release the debug file.
+        self.debug_set_output(self.debug_file)
 
     def dump_all_macros(self):
         # dump all macros
@@ -680,11 +1348,19 @@ class M4Processor(object):
     def set_trace(self, macro_name, flag):
         if macro_name is None:
             # trace/untrace all macros
-            for name, macros in self.macrostab.items():
-                macros[0].traced = flag
+            names = list(self.macrostab.keys())
         elif macro_name in self.macrostab:
             # trace/untrace specific macro
-            self.macrostab[macro_name][0].traced = flag
+            names = [macro_name]
+        else:
+            names = []
+        for name in names:
+            macros = self.macrostab[name]
+            if macros[0].traced != flag:
+                # macros may be shared with snapshots, change a copy
+                macro = copy.copy(macros[0])
+                macro.traced = flag
+                self.macrostab[name] = [macro] + macros[1:]
 
     def trace_header(self, id):
         header_str = 'm4trace:'
@@ -699,12 +1375,33 @@ class M4Processor(object):
                 header_str += 'id %d: ' % id
         return header_str
 
+    def trace_json(self, event, name, id, **fields):
+        # one JSON object per line, for trace_format 'json'
+        block = self.current_block()
+        record = {'event' : event, 'id' : id, 'name' : name,
+                  'file' : block.name if block else None,
+                  'line' : block.line if block else 0,
+                  'level' : self.expansion_level}
+        record.update(fields)
+        self.debug_write(json.dumps(record) + "\n")
+
     def trace_prepre(self, name, id):
+        if self.config['trace_format'] == 'json':
+            self.trace_json('enter', name, id)
+            return
         output_str = self.trace_header(id)
         output_str += '%s ...' % name
         self.debug_print(output_str)
 
     def trace_pre(self, name, id, arguments):
+        if self.config['trace_format'] == 'json':
+            if (self.debug_level & self.DEBUG_TRACE_ARGS) != 0:
+                self.trace_json('call', name, id, arguments=[argument \
+                    if isinstance(argument, str) else '<%s>' % find_builtin_by_addr(argument)[0] \
+                    for argument in arguments[1:]])
+            else:
+                self.trace_json('call', name, id)
+            return
         output_str = self.trace_header(id)
         output_str += '%s' % name
         num_args = len(arguments)
@@ -713,7 +1410,7 @@ class M4Processor(object):
             for i in range(1, num_args):
                 if i != 1:
                     output_str += ', '
-                if isinstance(arguments[i], (str, unicode)):
+                if isinstance(arguments[i], str):
                     output_str += '%s%s%s' % \
                         (self.config['left_quote'], arguments[i], self.config['right_quote'])
                 else:
@@ -721,13 +1418,19 @@ class M4Processor(object):
                     if not builtin:
                         raise Exception(
                             'INTERNAL ERROR: builtin not found in builtin table! (trace_pre ())')
-                    output_str += '<%s>' % builtin(0) # builtin name
+                    output_str += '<%s>' % builtin[0] # builtin name
             output_str += ')'
         if (self.debug_level & self.DEBUG_TRACE_CALL) != 0:
             output_str += ' -> ???'
             self.debug_print(output_str)
 
     def trace_post(self, name, id, num_args, expanded):
+        if self.config['trace_format'] == 'json':
+            if (self.debug_level & self.DEBUG_TRACE_EXPANSION) != 0:
+                self.trace_json('return', name, id, expansion=expanded or '')
+            else:
+                self.trace_json('return', name, id)
+            return
         output_str = ''
         if (self.debug_level & self.DEBUG_TRACE_CALL) != 0:
             output_str = self.trace_header(id)
@@ -739,29 +1442,287 @@ class M4Processor(object):
                 (self.config['left_quote'], expanded, self.config['right_quote'])
         self.debug_print(output_str)
 
+    # event hooks
+
+    # Events and the arguments passed to their callbacks:
+    #   token (token, line)             every token read by next_token ()
+    #   macro_enter (name, arguments)   before a macro is called
+    #   macro_exit (name, expansion)    after it returned
+    #   include (filename, filepath)    a file is read
+    #   divert (divnum)                 the current diversion changed
+    HOOK_EVENTS = ('token', 'macro_enter', 'macro_exit', 'include', 'divert')
+
+    def subscribe(self, event, callback):
+        if event not in self.HOOK_EVENTS:
+            raise Exception("Unknown event '%s'" % event)
+        self.hooks.setdefault(event, []).append(callback)
+        self.install_hooks()
+
+    def unsubscribe(self, event, callback):
+        callbacks = self.hooks.get(event, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self.hooks.pop(event, None)
+        self.install_hooks()
+
+    def install_hooks(self):
+        # The instrumented next_token () and call_macro () shadow the plain
+        # methods only while somebody listens, so unused hooks cost nothing.
+        if 'token' in self.hooks:
+            self.next_token = self.hooked_next_token
+        else:
+            self.__dict__.pop('next_token', None)
+        if 'macro_enter' in self.hooks or 'macro_exit' in self.hooks:
+            self.call_macro = self.hooked_call_macro
+        else:
+            self.__dict__.pop('call_macro', None)
+
+    def hooked_next_token(self):
+        (token, line) = M4Processor.next_token(self)
+        for callback in self.hooks.get('token', ()):
+            callback(token, line)
+        return (token, line)
+
+    def hooked_call_macro(self, macro, arguments):
+        for callback in self.hooks.get('macro_enter', ()):
+            callback(macro.name, arguments)
+        result = M4Processor.call_macro(self, macro, arguments)
+        for callback in self.hooks.get('macro_exit', ()):
+            callback(macro.name, result)
+        return result
+
+    def emit(self, event, *args):
+        for callback in self.hooks.get(event, ()):
+            callback(*args)
+
     # my debug stuff
-    def debug_output(self, msg):
+    def debug_output(self, msg, *args):
+        # ARGS are formatted into MSG only when debugging
         if not self.debug:
             return
-        print(msg)
+        if args:
+            msg = msg % args
+        self.debug_print(msg)
 
     def debug_builtin_call(self, args):
         if not self.debug:
             return
         name = args[0]
         arguments = args[1:]
-        self.debug_output("%s(%s)" % (name, ','.join(map(str, arguments))))
+        self.debug_output("%s(%s)", name, ','.join(map(str, arguments)))
 
 if __name__ == "__main__":
 
     optParser = argparse.ArgumentParser(description='Parser for M4 macro processor.')
 
-    optParser.add_argument('-s', '--source', default=None, dest='source', help='Source file')
+    optParser.add_argument('-s', '--source', default=None, dest='source',
+                           help='Source file, - or none for standard input')
+    optParser.add_argument('-o', '--output', default=None, dest='output',
+                           help='Output file, standard output by default')
+    optParser.add_argument('--watch', action='store_true', dest='watch',
+                           help='Render again whenever the source or its includes change')
+    optParser.add_argument('--memoize', action='store_true', dest='memoize',
+                           help='Cache expansions of pure user macros')
+    optParser.add_argument('--pure', action='append', default=[], dest='pure_macros',
+                           help='Treat macro as pure regardless of its body')
+    optParser.add_argument('--include-cache', default=None, dest='include_cache_dir',
+                           help='Directory caching macro definitions of included files')
+    optParser.add_argument('--shell-pool', type=int, default=0, dest='shell_pool',
+                           help='Run esyscmd and syscmd in this many persistent shells')
+    optParser.add_argument('--esyscmd-cache', default=None, dest='esyscmd_cache_dir',
+                           help='Directory caching esyscmd results')
+    optParser.add_argument('--esyscmd-env', action='append', default=[], dest='esyscmd_cache_env',
+                           help='Environment variable that is part of esyscmd cache keys')
+    optParser.add_argument('--esyscmd-input', action='append', default=[], dest='esyscmd_inputs',
+                           help='File whose changes invalidate cached esyscmd results')
+    optParser.add_argument('--esyscmd-cache-ttl', type=float, default=None,
+                           dest='esyscmd_cache_ttl', help='Lifetime of cached esyscmd results')
+    optParser.add_argument('--esyscmd-cache-size', type=int, default=None,
+                           dest='esyscmd_cache_size', help='Size limit of the esyscmd cache')
+    optParser.add_argument('--depfile', default=None, dest='depfile',
+                           help='Write the files read as a Makefile dependency rule')
+    optParser.add_argument('--dep-target', default=None, dest='dep_target',
+                           help='Target of the dependency rule, the output file or else '
+                                'the source without its .m4 suffix by default')
+    optParser.add_argument('--dep-missing', action='store_true', dest='dep_missing',
+                           help='List files probed by sinclude but not found as well')
+    optParser.add_argument('--serve', default=None, dest='serve',
+                           help='Serve render requests on this Unix domain socket')
+    optParser.add_argument('--prelude', default=None, dest='prelude',
+                           help='File processed once before the source, serving requests, '
+                                'batch jobs, watched or compiled renders')
+    optParser.add_argument('--batch', default=None, dest='batch',
+                           help='Render the jobs of a JSON manifest in parallel')
+    optParser.add_argument('-j', '--jobs', type=int, default=None, dest='jobs',
+                           help='Number of batch worker processes')
+    optParser.add_argument('--profile', action='store_true', dest='profile',
+                           help='Print time and bytes spent per macro to standard error')
+    optParser.add_argument('--profile-json', default=None, dest='profile_json',
+                           help='Write the per macro profile as JSON to this file')
+    optParser.add_argument('--flamegraph', default=None, dest='flamegraph',
+                           help='Sample the macro call stack into this collapsed stack file')
+    optParser.add_argument('--sample-interval', type=float, default=10.0, dest='sample_interval',
+                           help='Milliseconds between call stack samples')
+    optParser.add_argument('--metrics', default=None, dest='metrics',
+                           help='Write runtime metrics to this file at exit')
+    optParser.add_argument('--metrics-format', default=None, dest='metrics_format',
+                           choices=['json', 'prometheus'],
+                           help='Format of the metrics file, prometheus for *.prom files '
+                                'and json otherwise by default')
+    optParser.add_argument('--metrics-interval', type=float, default=None,
+                           dest='metrics_interval',
+                           help='Also write the metrics file every this many seconds')
+    optParser.add_argument('--memory-report', action='store_true', dest='memory_report',
+                           help='Print memory use per phase, diversion, input block and macro '
+                                'to standard error')
+    optParser.add_argument('--memory-report-json', default=None, dest='memory_report_json',
+                           help='Write the memory report as JSON to this file')
+    optParser.add_argument('--compile-cache', default=None, dest='compile_cache',
+                           help='Directory of templates compiled to Python against the prelude')
+    optParser.add_argument('--debugmode', default=None, dest='debugmode',
+                           help='Debug flags as for debugmode')
+    optParser.add_argument('--debugfile', default=None, dest='debugfile',
+                           help='Write traces to this file, standard error by default')
+    optParser.add_argument('--trace-format', default='text', dest='trace_format',
+                           choices=['text', 'json'],
+                           help='Write traces as text or as JSON lines')
+    optParser.add_argument('--trace-max-size', type=int, default=None, dest='trace_max_size',
+                           help='Size limit of the debug file in bytes')
+    optParser.add_argument('--trace-backups', type=int, default=0, dest='trace_backups',
+                           help='Rotate the debug file keeping this many old ones, '
+                                'beyond the size limit later traces are dropped otherwise')
+    optParser.add_argument('--wrap-order', default='lifo', dest='wrap_order',
+                           choices=['lifo', 'fifo'],
+                           help='Order of rereading m4wrap text, lifo as GNU m4 1.4 by default '
+                                'or fifo as POSIX')
+    optParser.add_argument('--max-macro-calls', type=int, default=None, dest='max_macro_calls',
+                           help='Stop after this many macro calls')
+    optParser.add_argument('--max-pushed-bytes', type=int, default=None, dest='max_pushed_bytes',
+                           help='Stop after pushing this many bytes of expansions for rescanning')
+    optParser.add_argument('--max-diversion-bytes', type=int, default=None,
+                           dest='max_diversion_bytes',
+                           help='Stop after diverting this many bytes')
+    optParser.add_argument('--time-limit', type=float, default=None, dest='time_limit',
+                           help='Stop after this many seconds')
     options = optParser.parse_args()
 
-    if not options.source or not os.path.exists(options.source):
+    config = {'memoize' : options.memoize,
+              'pure_macros' : options.pure_macros,
+              'include_cache_dir' : options.include_cache_dir,
+              'shell_pool' : options.shell_pool,
+              'esyscmd_cache_dir' : options.esyscmd_cache_dir,
+              'esyscmd_cache_env' : options.esyscmd_cache_env,
+              'esyscmd_inputs' : options.esyscmd_inputs,
+              'esyscmd_cache_ttl' : options.esyscmd_cache_ttl,
+              'esyscmd_cache_size' : options.esyscmd_cache_size,
+              'max_macro_calls' : options.max_macro_calls,
+              'max_pushed_bytes' : options.max_pushed_bytes,
+              'max_diversion_bytes' : options.max_diversion_bytes,
+              'time_limit' : options.time_limit,
+              'wrap_order' : options.wrap_order,
+              'debug_mode' : options.debugmode,
+              'debug_file' : options.debugfile,
+              'trace_format' : options.trace_format,
+              'trace_max_size' : options.trace_max_size,
+              'trace_backups' : options.trace_backups}
+
+    if options.batch:
+        from m4_batch import load_manifest, run_batch
+        sys.exit(run_batch(load_manifest(options.batch), config,
+                           options.prelude, options.jobs, dep_missing=options.dep_missing))
+
+    m4proc = M4Processor(config)
+
+    if options.serve:
+        from m4_server import serve
+        serve(m4proc, options.serve, options.prelude)
+        sys.exit(0)
+
+    # without -s standard input is read unless it's a terminal
+    stdin = options.source in (None, '-')
+    if (options.source is None and sys.stdin.isatty()) or (stdin and options.watch) or \
+       (not stdin and not os.path.exists(options.source)):
         sys.exit('Please specify source file: -s')
 
-    m4proc = M4Processor()
-    m4proc.process_file(options.source)
+    # a rule for the source itself would make it depend on itself
+    dep_target = options.dep_target or options.output
+    if options.depfile and not dep_target:
+        if stdin or not options.source.endswith('.m4'):
+            sys.exit('Please specify the target of the dependency rule: -o or --dep-target')
+        dep_target = options.source[:-len('.m4')]
+
+    if options.watch:
+        from m4_watch import watch
+        watch(config, options.source, options.prelude, options.output)
+        sys.exit(0)
+
+    memory = None
+    if options.memory_report or options.memory_report_json:
+        from m4_memory import MemoryReport
+        memory = MemoryReport(m4proc)
+        memory.start()
+
+    if options.prelude:
+        if memory:
+            memory.begin_phase('prelude')
+        m4proc.load_prelude(options.prelude)
+
+    compiler = None
+    if options.compile_cache:
+        from m4_compiler import TemplateCompiler
+        compiler = TemplateCompiler(m4proc.snapshot(), options.compile_cache)
+
+    profiler = None
+    if options.profile or options.profile_json:
+        from m4_profile import MacroProfiler
+        profiler = MacroProfiler(m4proc)
+        profiler.start()
+
+    metrics = None
+    if options.metrics:
+        from m4_metrics import Metrics
+        metrics = Metrics(m4proc)
+        metrics_format = options.metrics_format or \
+            ('prometheus' if options.metrics.endswith('.prom') else 'json')
+        metrics.start(options.metrics, metrics_format, options.metrics_interval)
+
+    sampler = None
+    if options.flamegraph:
+        from m4_sampler import StackSampler
+        sampler = StackSampler(m4proc, options.sample_interval / 1000.0)
+        sampler.start()
+
+    if options.output:
+        m4proc.output_stream = open(options.output, 'w')
+    if memory:
+        memory.begin_phase('main')
+    (exit_code, error) = m4proc.render('-' if stdin else options.source, compiler)
+    m4proc.close()
+    if memory:
+        memory.stop()
+        if options.memory_report:
+            memory.write_report(sys.stderr)
+        if options.memory_report_json:
+            memory.write_json(options.memory_report_json)
+    if metrics:
+        metrics.stop()
+    if sampler:
+        sampler.stop()
+        with open(options.flamegraph, 'w') as f:
+            sampler.write_collapsed(f)
+    if profiler:
+        profiler.stop()
+        if options.profile:
+            profiler.write_report(sys.stderr)
+        if options.profile_json:
+            profiler.write_json(options.profile_json)
+    if options.output:
+        m4proc.output_stream.close()
+    if options.depfile:
+        m4proc.write_depfile(options.depfile, dep_target, options.dep_missing)
+    if error:
+        sys.exit(str(error))
+    if exit_code:
+        sys.exit(exit_code)
 
@@ -0,0 +1,102 @@
+import json
+import time
+
+
+class MacroProfiler(object):
+    # Per macro call counts, total (outermost calls only) and self time,
+    # time collecting arguments and bytes of arguments and expansions.
+    # Instrumented methods shadow the processor's own while it runs.
+    CALLS = 0
+    TOTAL_TIME = 1
+    SELF_TIME = 2
+    ARGS_TIME = 3
+    ARG_BYTES = 4
+    EXPANSION_BYTES = 5
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.plain_expand_macro = type(processor).expand_macro
+        self.plain_collect_arguments = type(processor).collect_arguments
+        self.stats = {}
+        # [name, time of nested expansions] of the active expansions
+        self.stack = []
+        self.active = {}
+
+    def start(self):
+        self.processor.expand_macro = self.expand_macro
+        self.processor.collect_arguments = self.collect_arguments
+        self.processor.subscribe('macro_enter', self.macro_enter)
+        self.processor.subscribe('macro_exit', self.macro_exit)
+
+    def stop(self):
+        self.processor.__dict__.pop('expand_macro', None)
+        self.processor.__dict__.pop('collect_arguments', None)
+        self.processor.unsubscribe('macro_enter', self.macro_enter)
+        self.processor.unsubscribe('macro_exit', self.macro_exit)
+
+    def entry(self, name):
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = self.stats[name] = [0, 0.0, 0.0, 0.0, 0, 0]
+        return entry
+
+    def expand_macro(self, macro, in_argument=False):
+        name = macro.name
+        frame = [name, 0.0]
+        self.stack.append(frame)
+        self.active[name] = self.active.get(name, 0) + 1
+        start = time.perf_counter()
+        try:
+            return self.plain_expand_macro(self.processor, macro, in_argument)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            self.active[name] -= 1
+            entry = self.entry(name)
+            entry[self.CALLS] += 1
+            if self.active[name] == 0: # recursive calls are inside
+                entry[self.TOTAL_TIME] += elapsed
+            entry[self.SELF_TIME] += elapsed - frame[1]
+            if self.stack:
+                self.stack[-1][1] += elapsed
+
+    def collect_arguments(self, name):
+        start = time.perf_counter()
+        arguments = self.plain_collect_arguments(self.processor, name)
+        if self.active.get(name) == 1: # like total time
+            self.entry(name)[self.ARGS_TIME] += time.perf_counter() - start
+        return arguments
+
+    def macro_enter(self, name, arguments):
+        self.entry(name)[self.ARG_BYTES] += \
+            sum(len(argument) for argument in arguments[1:] if isinstance(argument, str))
+
+    def macro_exit(self, name, expansion):
+        if isinstance(expansion, str):
+            self.entry(name)[self.EXPANSION_BYTES] += len(expansion)
+
+    def report(self):
+        # list of per macro dictionaries, largest self time first
+        rows = []
+        for name, entry in self.stats.items():
+            rows.append({'name': name,
+                         'calls': entry[self.CALLS],
+                         'total_ms': entry[self.TOTAL_TIME] * 1000.0,
+                         'self_ms': entry[self.SELF_TIME] * 1000.0,
+                         'args_ms': entry[self.ARGS_TIME] * 1000.0,
+                         'arg_bytes': entry[self.ARG_BYTES],
+                         'expansion_bytes': entry[self.EXPANSION_BYTES]})
+        rows.sort(key=lambda row: -row['self_ms'])
+        return rows
+
+    def write_report(self, stream, limit=None):
+        stream.write("%10s %12s %12s %12s %12s %12s  %s\n" % \
+            ('calls', 'total ms', 'self ms', 'args ms', 'arg bytes', 'exp bytes', 'macro'))
+        for row in self.report()[:limit]:
+            stream.write("%10d %12.3f %12.3f %12.3f %12d %12d  %s\n" % \
+                (row['calls'], row['total_ms'], row['self_ms'], row['args_ms'],
+                 row['arg_bytes'], row['expansion_bytes'], row['name']))
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
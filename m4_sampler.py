@@ -0,0 +1,79 @@
+import sys
+import threading
+
+
+class StackSampler(object):
+    # Samples the m4 macro call stack of a processor every INTERVAL
+    # seconds from a background thread. The stack is read from the
+    # Python frames of the running expand_macro () calls, the processor
+    # itself isn't instrumented. Frames are named macro@file:line after
+    # the input position of the call, or just by the macro name when
+    # LINES is false.
+    def __init__(self, processor, interval=0.01, lines=True):
+        self.processor = processor
+        self.code = type(processor).expand_macro.__code__
+        self.interval = interval
+        self.lines = lines
+        self.samples = {} # collapsed stack -> count
+        self.frame_names = {}
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='m4-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.sample(frame)
+
+    def sample(self, frame):
+        # Expansions still being rescanned are on the input stack, the
+        # calls collecting their arguments are Python frames. Both are
+        # ordered by macro call id: a call is nested in the expansions
+        # pushed before it started, whether or not their blocks are
+        # still on the stack. A call comes before the blocks it pushed.
+        calls = []
+        while frame is not None:
+            if frame.f_code is self.code:
+                local = frame.f_locals
+                if local.get('self') is self.processor:
+                    # a call that hasn't got its id yet is the innermost
+                    calls.append((local.get('my_call_id', sys.maxsize), 0,
+                                  local['macro'].name, local.get('block')))
+            frame = frame.f_back
+        for block in list(self.processor.stack):
+            if block.macro is not None:
+                calls.append((block.call_id, 1, block.macro, block))
+        calls.sort(key=lambda call: call[:2])
+        stack = [self.frame_name(name, block) for (call_id, order, name, block) in calls]
+        if not stack:
+            stack.append('[scan]')
+        key = ';'.join(stack)
+        self.samples[key] = self.samples.get(key, 0) + 1
+
+    def frame_name(self, name, block):
+        if not self.lines or block is None or block.name is None:
+            return name
+        key = (name, block.name, block.line)
+        frame_name = self.frame_names.get(key)
+        if frame_name is None:
+            filename = str(block.name).replace(';', '_').replace(' ', '_')
+            frame_name = self.frame_names[key] = '%s@%s:%d' % (name, filename, block.line)
+        return frame_name
+
+    def write_collapsed(self, stream):
+        # one "frame;frame;frame count" line per distinct stack, the
+        # input of flamegraph.pl, inferno or speedscope
+        for (stack, count) in sorted(self.samples.items()):
+            stream.write('%s %d\n' % (stack, count))
@@ -0,0 +1,151 @@
+import io
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import socketserver
+import multiprocessing
+
+
+class RenderStats(object):
+    # Latency and request counters of the render daemon. They live in
+    # shared memory, so forked children update and report the daemon's
+    # own counters.
+    def __init__(self):
+        # requests, errors, total time, max time
+        self.counters = multiprocessing.RawArray('d', 4)
+        self.lock = multiprocessing.Lock()
+        self.started = time.time()
+
+    def add(self, elapsed, failed):
+        counters = self.counters
+        with self.lock:
+            counters[0] += 1
+            if failed:
+                counters[1] += 1
+            counters[2] += elapsed
+            counters[3] = max(counters[3], elapsed)
+
+    def report(self):
+        with self.lock:
+            (requests, errors, total_time, max_time) = self.counters[:]
+        mean_time = total_time / requests if requests else 0.0
+        return {'requests': int(requests),
+                'errors': int(errors),
+                'mean_ms': mean_time * 1000.0,
+                'max_ms': max_time * 1000.0,
+                'uptime_s': time.time() - self.started}
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    # One JSON request per line:
+    #   {"source": text, "name": name, "defines": {name: value}}
+    #   {"command": "stats"}
+    # answered by one JSON line
+    #   {"output": text, "errors": text, "exit_code": code,
+    #    "dependencies": [path], "elapsed_ms": ms}
+    # or {"error": message}.
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        start = time.time()
+        failed = False
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if request.get('command') == 'stats':
+                response = self.server.stats.report()
+            else:
+                response = self.render(request)
+        except Exception as e:
+            failed = True
+            response = {'error': str(e)}
+        elapsed = time.time() - start
+        response['elapsed_ms'] = elapsed * 1000.0
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+        self.server.stats.add(elapsed, failed)
+
+    def render(self, request):
+        processor = self.server.clone_processor()
+        processor.error_stream = io.StringIO()
+        for name, value in request.get('defines', {}).items():
+            processor.define_user_macro(name, value)
+        output = processor.process_string(request.get('source', ''), request.get('name', '-'))
+        # files read by the render and the prelude, for a depfile
+        dependencies = [path for path, exists in processor.dependencies.items() if exists]
+        return {'output': output,
+                'errors': processor.error_stream.getvalue(),
+                'exit_code': processor.exit_code,
+                'dependencies': dependencies}
+
+
+class RenderServerMixIn(object):
+    def setup_stats(self, processor):
+        self.processor = processor
+        self.stats = RenderStats()
+
+    def server_close(self):
+        super(RenderServerMixIn, self).server_close()
+        sys.stderr.write('m4 render daemon: %s\n' % json.dumps(self.stats.report()))
+
+
+if hasattr(os, 'fork'):
+    class RenderServer(RenderServerMixIn, socketserver.ForkingMixIn,
+                       socketserver.UnixStreamServer):
+        # Every request is rendered in a forked child, which shares the
+        # preloaded processor with the daemon copy-on-write. Children
+        # count their requests in the daemon's shared counters.
+        def clone_processor(self):
+            return self.processor
+else:
+    class RenderServer(RenderServerMixIn, socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+        # Without fork every request gets its own fork of a snapshot.
+        def setup_stats(self, processor):
+            RenderServerMixIn.setup_stats(self, processor)
+            self.snapshot = processor.snapshot()
+
+        def clone_processor(self):
+            return self.snapshot.fork()
+
+
+def serve(processor, socket_path, prelude=None):
+    # Load PRELUDE once into PROCESSOR and serve renders on SOCKET_PATH.
+    if prelude:
+        processor.load_prelude(prelude)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = RenderServer(socket_path, RenderHandler)
+    server.setup_stats(processor)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def render(socket_path, source, name='-', defines=None):
+    # Client side: send one render request and return the response.
+    request = {'source': source, 'name': name, 'defines': defines or {}}
+    return send_request(socket_path, request)
+
+
+def send_request(socket_path, request):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        client.close()
+    return json.loads(data.decode('utf-8'))
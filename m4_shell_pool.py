@@ -0,0 +1,160 @@
+import os
+import time
+import uuid
+import shlex
+import select
+import signal
+import atexit
+import threading
+import subprocess
+
+
+class Shell(object):
+    # A long-lived /bin/sh reading commands from a pipe. Every command
+    # runs in a subshell and is followed by a marker line carrying its
+    # exit status.
+    def __init__(self):
+        self.process = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        start_new_session=True)
+        self.stdout = self.process.stdout.fileno()
+        self.stderr = self.process.stderr.fileno()
+        os.set_blocking(self.stderr, False)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, command, merge_errors, timeout=None):
+        # Returns (exit code, output bytes, error bytes), the exit code is
+        # None if the shell died. With MERGE_ERRORS the command's stderr
+        # is part of its output.
+        marker = uuid.uuid4().hex.encode('ascii')
+        script = "(cd %s && eval %s) </dev/null%s; printf '%s %%d\\n' $?\n" % \
+            (shlex.quote(os.getcwd()), shlex.quote(command), ' 2>&1' if merge_errors else '',
+             marker.decode('ascii'))
+        try:
+            self.process.stdin.write(script.encode())
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return (None, b'', b'')
+        deadline = time.time() + timeout if timeout is not None else None
+        data = b''
+        errors = b''
+        while True:
+            index = data.find(marker + b' ')
+            if index != -1 and data.endswith(b'\n'):
+                returncode = int(data[index + len(marker) + 1:].strip())
+                return (returncode, data[:index], errors + self.read_errors())
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise subprocess.TimeoutExpired(command, timeout)
+            # stderr is read meanwhile so a full pipe can't block the command
+            (readable, dummy, dummy) = select.select([self.stdout, self.stderr], [], [], wait)
+            if self.stderr in readable:
+                errors += self.read_errors()
+            if self.stdout not in readable:
+                continue
+            chunk = os.read(self.stdout, 65536)
+            if not chunk:
+                return (None, data, errors + self.read_errors())
+            data += chunk
+
+    def read_errors(self):
+        errors = b''
+        while True:
+            try:
+                chunk = os.read(self.stderr, 65536)
+            except BlockingIOError:
+                return errors
+            if not chunk:
+                return errors
+            errors += chunk
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+        self.close()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+
+class ShellPool(object):
+    # Pool of up to SIZE shell coprocesses for esyscmd and syscmd.
+    def __init__(self, size=1):
+        self.size = size
+        self.lock = threading.Condition()
+        self.idle = []
+        self.count = 0
+        self.restarts = 0
+        self.pid = os.getpid()
+        atexit.register(self.shutdown)
+
+    def acquire(self):
+        with self.lock:
+            if os.getpid() != self.pid:
+                # forked child, the parent's shells aren't ours
+                self.idle = []
+                self.count = 0
+                self.pid = os.getpid()
+            while not self.idle and self.count >= self.size:
+                self.lock.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.count += 1
+        try:
+            return Shell()
+        except Exception:
+            self.release(None)
+            raise
+
+    def release(self, shell):
+        with self.lock:
+            if shell is not None:
+                self.idle.append(shell)
+            else:
+                self.count -= 1
+            self.lock.notify()
+
+    def run(self, command, capture, timeout=None):
+        # Returns the exit code, the output and the stderr of COMMAND,
+        # which is part of the output with CAPTURE (esyscmd).
+        shell = self.acquire()
+        try:
+            (returncode, output, errors) = shell.run(command, capture, timeout)
+        except subprocess.TimeoutExpired:
+            shell.kill()
+            self.restarts += 1
+            self.release(None)
+            raise Exception("Command '%s' timed out after %s seconds" % (command, timeout))
+        except BaseException:
+            shell.kill()
+            self.release(None)
+            raise
+        if returncode is None or not shell.alive():
+            # crashed shell, the next command starts a new one
+            shell.kill()
+            self.restarts += 1
+            self.release(None)
+            if returncode is None:
+                # killed with the command, as a shell run by subprocess
+                returncode = shell.process.returncode or -signal.SIGKILL
+        else:
+            self.release(shell)
+        return (returncode, output.decode(), errors.decode())
+
+    def shutdown(self):
+        with self.lock:
+            if os.getpid() != self.pid:
+                return
+            for shell in self.idle:
+                shell.kill()
+            self.count -= len(self.idle)
+            self.idle = []
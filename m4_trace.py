@@ -0,0 +1,65 @@
+import os
+import atexit
+import weakref
+
+
+# open writers, flushed when the interpreter exits
+open_writers = weakref.WeakSet()
+
+
+@atexit.register
+def flush_all():
+    for writer in list(open_writers):
+        writer.flush()
+
+
+class TraceWriter(object):
+    # Buffered trace file kept open between writes. Beyond MAX_SIZE bytes
+    # the file is rotated to PATH.1 ... PATH.BACKUPS, or, without
+    # backups, further traces are dropped after a marker line.
+    def __init__(self, path, max_size=None, backups=0, buffer_size=65536):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self.capped = False
+        self.stream = None
+        self.open()
+        open_writers.add(self)
+
+    def open(self):
+        self.stream = open(self.path, 'a', buffering=self.buffer_size)
+        self.size = self.stream.tell()
+
+    def write(self, text):
+        if self.capped:
+            return
+        if self.max_size is not None and self.size + len(text) > self.max_size and self.size > 0:
+            if self.backups > 0:
+                self.rotate()
+            else:
+                self.stream.write('m4trace: trace truncated at %d bytes\n' % self.max_size)
+                self.stream.flush()
+                self.capped = True
+                return
+        self.stream.write(text)
+        self.size += len(text)
+
+    def rotate(self):
+        self.stream.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = '%s.%d' % (self.path, index)
+            if os.path.exists(source):
+                os.replace(source, '%s.%d' % (self.path, index + 1))
+        os.replace(self.path, self.path + '.1')
+        self.open()
+
+    def flush(self):
+        if self.stream is not None and not self.stream.closed:
+            self.stream.flush()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        open_writers.discard(self)
@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+
+from m4_processor import M4Processor
+
+
+class InotifyWatcher(object):
+    # Waits for changes of a set of files through Linux inotify. The
+    # directories are watched, editors often replace files by renaming.
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+           IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {} # watch descriptor -> directory
+
+    def watch(self, paths):
+        for wd in list(self.directories):
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.directories = {}
+        self.paths = set(os.path.abspath(path) for path in paths)
+        for directory in set(os.path.dirname(path) for path in self.paths):
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode(), self.MASK)
+            if wd >= 0:
+                self.directories[wd] = directory
+
+    def wait(self, settle=0.05):
+        # Block until a watched file changes, return its path.
+        while True:
+            select.select([self.fd], [], [])
+            changed = self.read_changes()
+            if changed:
+                # let the editor finish writing
+                time.sleep(settle)
+                self.read_changes()
+                return changed[0]
+
+    def read_changes(self):
+        changed = []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset : offset + length].rstrip(b'\0').decode()
+            offset += length
+            path = os.path.join(self.directories.get(wd, ''), name)
+            if path in self.paths:
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    # Fallback comparing modification times every INTERVAL seconds.
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.mtimes = {}
+
+    def mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch(self, paths):
+        self.mtimes = dict((path, self.mtime(path)) for path in paths)
+
+    def wait(self):
+        while True:
+            time.sleep(self.interval)
+            for path, mtime in self.mtimes.items():
+                if self.mtime(path) != mtime:
+                    return path
+
+    def close(self):
+        pass
+
+
+def make_watcher():
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher()
+
+
+def load_prelude(config, prelude):
+    processor = M4Processor(config)
+    if prelude:
+        processor.load_prelude(prelude)
+    return processor.snapshot()
+
+
+def watch(config, source, prelude=None, output=None, log=sys.stderr):
+    # Render SOURCE, then render again whenever it, one of the files it
+    # read or the PRELUDE changes. The prelude is processed again only
+    # when one of its own files changed.
+    watcher = make_watcher()
+    snapshot = load_prelude(config, prelude)
+    iteration = 0
+    try:
+        while True:
+            iteration += 1
+            start = time.time()
+            stream = open(output, 'w') if output else sys.stdout
+            processor = snapshot.fork(stream)
+            try:
+                (exit_code, error) = processor.render(source)
+                if error:
+                    status = 'error: %s' % error
+                elif exit_code:
+                    status = 'm4exit(%d)' % exit_code
+                else:
+                    status = 'ok'
+            except Exception as e:
+                status = 'error: %s' % e
+            finally:
+                processor.close()
+                if output:
+                    stream.close()
+                else:
+                    stream.flush()
+            log.write("m4 watch: render %d %s in %.2f ms\n" % \
+                (iteration, status, (time.time() - start) * 1000.0))
+            log.flush()
+            files = [os.path.abspath(path) for path, exists in processor.dependencies.items()]
+            watcher.watch(files)
+            changed = watcher.wait()
+            if changed in [os.path.abspath(path) for path in snapshot.dependencies]:
+                snapshot = load_prelude(config, prelude)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
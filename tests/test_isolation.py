@@ -0,0 +1,94 @@
+import io
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from m4_processor import M4Processor
+
+CONFIG = {'sync_output' : False}
+
+PRELUDE = """define(`greet', `hello $1')dnl
+define(`count', `0')dnl
+divert(5)prelude trailer
+divert`'dnl
+"""
+
+# ID is defined by every render, SHARED only by the even ones
+SOURCE = """greet(ID)
+define(`count', incr(count))count
+ifdef(`SHARED', `shared ID', `alone ID')
+errprint(`error 'ID`
+')divert(1)diverted ID
+divert(-1)discarded ID
+divert`'dnl
+ifelse(eval(ID % 3), 0, `m4exit(eval(ID % 7))')dnl
+last ID
+"""
+
+
+def render(processor, index):
+    processor.define_user_macro('ID', str(index))
+    if index % 2 == 0:
+        processor.define_user_macro('SHARED', 'yes')
+    output = processor.process_string(SOURCE, 'render%d.m4' % index)
+    return (output, processor.error_stream.getvalue(), processor.exit_code,
+            processor.diversions)
+
+
+def render_fork(snapshot, index):
+    return render(snapshot.fork(error=io.StringIO()), index)
+
+
+def load_prelude():
+    processor = M4Processor(CONFIG, error=io.StringIO())
+    for chunk in processor.iter_output([PRELUDE], undivert=False):
+        pass
+    return processor
+
+
+def render_alone(index):
+    # the same render by a processor of its own
+    return render(load_prelude(), index)
+
+
+class ForkIsolationTest(unittest.TestCase):
+    RENDERS = 200
+
+    def setUp(self):
+        self.snapshot = load_prelude().snapshot()
+
+    def test_concurrent_forks(self):
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda index: render_fork(self.snapshot, index),
+                                        range(self.RENDERS)))
+        for (index, result) in enumerate(results):
+            self.assertEqual(result, render_alone(index), 'render %d' % index)
+
+    def test_results(self):
+        (output, errors, exit_code, diversions) = render_fork(self.snapshot, 2)
+        self.assertEqual(output, 'hello 2\n1\nshared 2\nlast 2\n'
+                                 'diverted 2\nprelude trailer\n')
+        self.assertEqual(errors, 'error 2\n')
+        self.assertIsNone(exit_code)
+        self.assertEqual(diversions, {})
+        (output, errors, exit_code, diversions) = render_fork(self.snapshot, 3)
+        self.assertEqual(output, 'hello 3\n1\nalone 3\n')
+        self.assertEqual(errors, 'error 3\n')
+        self.assertEqual(exit_code, 3)
+
+    def test_snapshot_unchanged(self):
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda index: render_fork(self.snapshot, index),
+                              range(self.RENDERS)))
+        processor = self.snapshot.fork(error=io.StringIO())
+        self.assertEqual(processor.process_string('ID SHARED count\n'), 'ID SHARED 0\n'
+                                                                       'prelude trailer\n')
+        self.assertEqual(self.snapshot.diversions, {5 : 'prelude trailer\n'})
+        self.assertIsNone(processor.exit_code)
+
+
+if __name__ == '__main__':
+    unittest.main()